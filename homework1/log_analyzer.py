@@ -2,17 +2,56 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import array
+import base64
+import bisect
+import calendar
+import contextlib
+import cProfile
+import ctypes
+import ctypes.util
+import fnmatch
+import itertools
 import json
+import math
+import operator
+import random
 import re
 import os
 import gzip
+import heapq
 import logging
+import pstats
+import resource
+import select
+import signal
+import struct
 import collections
 import time
 import glob
+import sys
+import mmap
+import multiprocessing
+import subprocess
+import threading
+import zlib
+import Queue
+import StringIO
+import cStringIO
+from distutils.spawn import find_executable
 from datetime import datetime
 from string import Template
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # log_format ui_short '$remote_addr $remote_user $http_x_real_ip [$time_local] "$request" '
 #                     '$status $body_bytes_sent "$http_referer" '
 #                     '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
@@ -24,9 +63,91 @@ config = {
     "REPORT_TEMPLATE": "report-{date}.html",
     "LOG_DIR": "./log",
     "LOG_NAME_PATTERN": "nginx-access-ui.log-*",
-    "ERRORS_LIMIT": 100,
-    "TS_FILE": "./log_analyzer.ts"
+    "LIVE_LOG_NAME": "nginx-access-ui.log",
+    "ERRORS_LIMIT": 0.01,
+    "TS_FILE": "./log_analyzer.ts",
+    "AGGREGATES_DIR": "./aggregates",
+    "WORKERS": 1,
+    "QUANTILE_MODE": "exact",
+    "PARSER": "fast",
+    "URL_DROP_QUERY": False,
+    "URL_NUMERIC_IDS": False,
+    "URL_TEMPLATES": [],
+    "GZIP_BACKEND": "auto",
+    "EXPORT_DIR": "./columns",
+    "ENGINE": "python",
+    "TIMELINE_RESOLUTION": None,
+    "REPORT_COMPRESSION": [],
+    "REPORT_DATA_FILE": False,
+    "METRICS_FORMAT": "json",
+    "LOG_DIRS": [],
+    "WATCH_INTERVAL": 60
+}
+
+LINES_PER_TASK = 100000
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+DECOMPRESS_QUEUE_SIZE = 8
+REPORT_BUFFER_SIZE = 1024 * 1024
+# rows of REPORT_DATA_FILE go to files of this many rows, the report page loads the next one on scroll
+REPORT_DATA_FILE_ROWS = 1000
+PROGRESS_INTERVAL = 30
+PROFILE_TOP = 30
+METRICS_EXTENSIONS = {
+    "json": ".metrics.json",
+    "prometheus": ".prom"
+}
+# watch mode: a rotated file is processed once its dir has been quiet for WATCH_SETTLE seconds
+WATCH_SETTLE = 1.0
+WATCH_POLL_INTERVAL = 5.0
+INOTIFY_EVENTS = 0x00000008 | 0x00000080  # IN_CLOSE_WRITE | IN_MOVED_TO
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+INOTIFY_BUFFER_SIZE = 64 * 1024
+SKETCH_SIZE = 200
+URL_CACHE_SIZE = 100000
+# corrupted lines: only the first ERRORS_LOGGED of every parsed file are logged, whatever the number of workers,
+# and a share limit is checked once ERRORS_MIN_LINES lines have been read
+ERRORS_LOGGED = 10
+ERRORS_MIN_LINES = 1000
+ERROR_LINE_SIZE = 500
+# log-scaled latency buckets: 1ms .. 1000s, every bucket is 10% wider than the previous one
+HISTOGRAM_MIN = 0.001
+HISTOGRAM_MAX = 1000.0
+HISTOGRAM_GROWTH = 1.1
+HISTOGRAM_BOUNDS = [HISTOGRAM_MIN * HISTOGRAM_GROWTH ** i for i in
+                    xrange(int(math.ceil(math.log(HISTOGRAM_MAX / HISTOGRAM_MIN, HISTOGRAM_GROWTH))) + 1)]
+REPORT_PERCENTILES = (90, 95, 99)
+TIMELINE_RESOLUTIONS = {
+    "minute": 60,
+    "hour": 3600
 }
+NUMERIC_SEGMENT = re.compile(r"(?<=/)\d+(?=/|$)")
+LOG_LINE_PATTERN = re.compile(
+    r"(?P<remote_addr>[\d\.]+)\s"
+    r"(?P<remote_user>\S*)\s+"
+    r"(?P<http_x_real_ip>\S*)\s"
+    r"\[(?P<time_local>.*?)\]\s"
+    r'"(?P<request>.*?)"\s'
+    r"(?P<status>\d+)\s"
+    r"(?P<body_bytes_sent>\S*)\s"
+    r'"(?P<http_referer>.*?)"\s'
+    r'"(?P<http_user_agent>.*?)"\s'
+    r'"(?P<http_x_forwarded_for>.*?)"\s'
+    r'"(?P<http_X_REQUEST_ID>.*?)"\s'
+    r'"(?P<http_X_RB_USER>.*?)"\s'
+    r"(?P<request_time>\d+\.\d+)\s*"
+)
+LOG_DATE_PATTERN = re.compile(r"(\d{8})")
+# request_time is kept as integer milliseconds, nginx logs it with millisecond resolution
+COLUMNS = (
+    ("url", "I"),
+    ("status", "H"),
+    ("user_agent", "I"),
+    ("request_time_ms", "I"),
+    ("timestamp", "l")
+)
+ENGINES = ("python", "numpy")
+DICTIONARY_COLUMNS = ("url", "status", "user_agent")
+REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
 
 
 def load_config(path):
@@ -51,61 +172,325 @@ def get_latest_log_file_path(log_dir, name_pattern):
     if not list_of_files:
         raise StandardError("Log folder {} is empty.".format(log_dir))
 
-    return max(list_of_files, key=lambda f: re.findall("(\d{8})", f))
+    return max(list_of_files, key=lambda f: LOG_DATE_PATTERN.findall(f))
+
 
+def read_blocks_gzip(path):
+    with gzip.open(path, 'rb') as log_file:
+        for block in iter(lambda: log_file.read(READ_BLOCK_SIZE), ''):
+            yield block
 
-def xreadlines(path):
+
+def read_blocks_zlib(path):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    in_member = False
+    with open(path, 'rb') as log_file:
+        for block in iter(lambda: log_file.read(READ_BLOCK_SIZE), ''):
+            # a gzip file may consist of several concatenated members
+            while block:
+                in_member = True
+                data = decompressor.decompress(block)
+                if data:
+                    yield data
+                block = decompressor.unused_data
+                if block:
+                    tail = decompressor.flush()
+                    if tail:
+                        yield tail
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if in_member:
+        # python 2 has no decompressor.eof: after the end of a member zlib leaves more input in unused_data,
+        # inside a truncated member it consumes it
+        try:
+            decompressor.decompress("\0")
+        except zlib.error:
+            pass
+        if decompressor.unused_data != "\0":
+            raise EOFError("Compressed file {} ended before the end of the stream".format(path))
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def read_blocks_threaded(path):
+    # zlib releases the GIL, so decompression runs in parallel with parsing
+    blocks = Queue.Queue(maxsize=DECOMPRESS_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def decompress():
+        # once the reader stops, the rest of the file is not decompressed
+        reader = read_blocks_zlib(path)
+        try:
+            for block in reader:
+                if not put(block):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+        finally:
+            reader.close()
+
+    thread = threading.Thread(target=decompress)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def read_blocks_command(path, command):
+    process = subprocess.Popen([command, "-dc", path], stdout=subprocess.PIPE)
+    try:
+        for block in iter(lambda: process.stdout.read(READ_BLOCK_SIZE), ''):
+            yield block
+    except GeneratorExit:
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        raise RuntimeError("{} exited with code {} on {}".format(command, process.returncode, path))
+
+
+GZIP_COMMANDS = {
+    "pigz": "pigz",
+    "zcat": "gzip"
+}
+GZIP_BACKENDS = {
+    "gzip": read_blocks_gzip,
+    "zlib": read_blocks_zlib,
+    "thread": read_blocks_threaded,
+    "pigz": lambda path: read_blocks_command(path, GZIP_COMMANDS["pigz"]),
+    "zcat": lambda path: read_blocks_command(path, GZIP_COMMANDS["zcat"])
+}
+
+
+def get_gzip_backend(name):
+    if name == "auto":
+        return "pigz" if find_executable("pigz") else "thread"
+    return name
+
+
+def split_lines(blocks):
+    # lines keep the trailing newline, as lines read from a plain file do
+    tail = ''
+    for block in blocks:
+        block = tail + block
+        end = block.rfind('\n') + 1
+        tail = block[end:]
+        for line in cStringIO.StringIO(block[:end]):
+            yield line
+    if tail:
+        yield tail
+
+
+def xreadlines(path, gzip_backend="auto"):
     if path.endswith(".gz"):
-        log_file = gzip.open(path, 'rb')
-    else:
-        log_file = open(path, 'r')
-    for line in log_file:
+        for line in split_lines(GZIP_BACKENDS[get_gzip_backend(gzip_backend)](path)):
+            yield line
+        return
+    for line in xreadlines_range(path):
         yield line
-    log_file.close()
 
 
-def apply_filters(source, errors_limit, filters):
-    n_errors = 0
-    for string_dict in source:
-        result = {}
-        for key, filter_func in filters.iteritems():
-            try:
-                result[key] = filter_func(string_dict[key])
-            except BaseException:
-                logging.error("Error occurs in: {}".format(string_dict))
-                n_errors += 1
-                if n_errors >= errors_limit:
-                    raise RuntimeError("Too many lines in log file are corrupted.")
-        if result:
+# plain logs and the byte ranges of workers are read through mmap: mmap.readline does not copy the line
+# through the file buffer and is ~5x faster than seek + file.readline
+def xreadlines_range(path, start=0, end=None):
+    with open(path, 'rb') as log_file:
+        buf = open_mmap(log_file)
+        if buf is None:
+            return
+        try:
+            end = len(buf) if end is None else min(end, len(buf))
+            buf.seek(start)
+            readline, tell = buf.readline, buf.tell
+            while tell() < end:
+                yield readline()
+        finally:
+            buf.close()
+
+
+def open_mmap(log_file):
+    if os.fstat(log_file.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def get_chunks(path, n_chunks):
+    file_size = os.path.getsize(path)
+    chunk_size = max(file_size // n_chunks, 1)
+    chunks = []
+    with open(path, 'rb') as log_file:
+        buf = open_mmap(log_file)
+        start = 0
+        while start < file_size:
+            end = buf.find("\n", start + chunk_size - 1) + 1
+            if end == 0 or start + chunk_size >= file_size:
+                end = file_size
+            chunks.append((start, end))
+            start = end
+        if buf is not None:
+            buf.close()
+    return chunks
+
+
+class ErrorCounter(object):
+    # errors_limit is the number of corrupted lines that stops parsing, or their share of all lines
+    # when it is below 1; the share is checked early once there are enough lines and again at the end.
+    # A worker of a parallel run counts with errors_limit None: it neither checks the limit nor logs,
+    # it keeps the first corrupted lines for the main process, which merges the counts of every part
+    def __init__(self, errors_limit, stats=None):
+        self.errors_limit = errors_limit
+        self.stats = stats
+        self.n_errors = 0
+        self.n_lines = 0
+        self.n_logged = 0
+        self.samples = []
+
+    def log(self, line):
+        if self.errors_limit is None:
+            self.samples.append(str(line)[:ERROR_LINE_SIZE])
+        else:
+            logging.error("Error occurs in: {}".format(str(line)[:ERROR_LINE_SIZE]))
+        self.n_logged += 1
+
+    def add(self, line, n_lines):
+        self.n_errors += 1
+        if self.stats is not None:
+            self.stats["errors"] += 1
+        if self.n_logged < ERRORS_LOGGED:
+            self.log(line)
+        self.check(n_lines)
+
+    def merge(self, n_errors, n_lines, samples):
+        for line in samples[:ERRORS_LOGGED - self.n_logged]:
+            self.log(line)
+        self.n_errors += n_errors
+        self.n_lines += n_lines
+        if self.stats is not None:
+            self.stats["errors"] += n_errors
+        self.check(self.n_lines)
+
+    def check(self, n_lines, is_finished=False):
+        if self.errors_limit is None:
+            return
+        if self.errors_limit >= 1:
+            if self.n_errors >= self.errors_limit:
+                raise RuntimeError("Too many lines in log file are corrupted.")
+        elif (is_finished or n_lines >= ERRORS_MIN_LINES) and self.n_errors > self.errors_limit * n_lines:
+            raise RuntimeError("Too many lines in log file are corrupted: {} of {}.".format(self.n_errors, n_lines))
+
+    def finish(self, n_lines):
+        self.n_lines = n_lines
+        if self.errors_limit is None:
+            return
+        if self.n_errors > self.n_logged:
+            logging.error("{} more corrupted lines are not logged.".format(self.n_errors - self.n_logged))
+        self.check(n_lines, True)
+
+
+def get_error_counter(errors_limit, stats=None):
+    # the parsers take the counter of a parallel part instead of the limit
+    if isinstance(errors_limit, ErrorCounter):
+        return errors_limit
+    return ErrorCounter(errors_limit, stats)
+
+
+def compile_filters(filters):
+    # one generated function converts all the fields of a line, as collections.namedtuple generates its class
+    names = sorted(filters)
+    source = "lambda fields: {{{}}}".format(", ".join("{0!r}: filter_{1}(fields[{0!r}])".format(name, i)
+                                                      for i, name in enumerate(names)))
+    return eval(source, {"filter_{}".format(i): filters[name] for i, name in enumerate(names)})
+
+
+def apply_filters(source, errors_limit, filters, stats=None):
+    convert = compile_filters(filters)
+    errors = get_error_counter(errors_limit, stats)
+    n_lines = 0
+    for n_lines, string_dict in enumerate(source, 1):
+        try:
+            result = convert(string_dict)
+        except Exception:
+            errors.add(string_dict, n_lines)
+        else:
             yield result
+    errors.finish(n_lines)
 
 
-def parse_log(path, errors_limit):
-    pattern = re.compile(
-        r"(?P<remote_addr>[\d\.]+)\s"
-        r"(?P<remote_user>\S*)\s+"
-        r"(?P<http_x_real_ip>\S*)\s"
-        r"\[(?P<time_local>.*?)\]\s"
-        r'"(?P<request>.*?)"\s'
-        r"(?P<status>\d+)\s"
-        r"(?P<body_bytes_sent>\S*)\s"
-        r'"(?P<http_referer>.*?)"\s'
-        r'"(?P<http_user_agent>.*?)"\s'
-        r'"(?P<http_x_forwarded_for>.*?)"\s'
-        r'"(?P<http_X_REQUEST_ID>.*?)"\s'
-        r'"(?P<http_X_RB_USER>.*?)"\s'
-        r"(?P<request_time>\d+\.\d+)\s*"
-    )
-    log_lines = xreadlines(path)
-
-    parsed_line_dict = (pattern.match(line).groupdict() for line in log_lines)
+def regex_parse_lines(log_lines, errors_limit, stats=None):
+    # a line the pattern does not match keeps only its text, apply_filters counts and logs it as corrupted
+    matches = ((line, LOG_LINE_PATTERN.match(line)) for line in log_lines)
+    parsed_line_dict = (match.groupdict() if match else {"line": line} for line, match in matches)
 
     filters = {
         "request": lambda req: req.split(" ")[1],
-        "request_time": float
+        "request_time": float,
+        "time_local": str
     }
 
-    return apply_filters(parsed_line_dict, errors_limit, filters)
+    return ((r["request"], r["request_time"], r["time_local"])
+            for r in apply_filters(parsed_line_dict, errors_limit, filters, stats))
+
+
+def fast_parse_lines(log_lines, errors_limit, stats=None):
+    # ui_short: time_local is bracketed, the url is the second word of the first quoted field after it,
+    # request_time is the last field
+    errors = get_error_counter(errors_limit, stats)
+    n_lines = 0
+    for n_lines, line in enumerate(log_lines, 1):
+        try:
+            time_start = line.index('[') + 1
+            time_end = line.index(']', time_start)
+            request_start = line.index('"', time_end) + 1
+            request_end = line.index('"', request_start)
+            url_start = line.index(" ", request_start, request_end) + 1
+            url_end = line.find(" ", url_start, request_end)
+            url = line[url_start:url_end if url_end != -1 else request_end]
+            line_end = len(line.rstrip())
+            request_time = line[line.rindex(" ", request_end, line_end) + 1:line_end]
+            # float() also takes nan, inf, signs and exponents, the regex parser accepts only \d+\.\d+
+            whole, _, fraction = request_time.partition(".")
+            if not (whole.isdigit() and fraction.isdigit()):
+                raise ValueError("request_time is not a decimal: {}".format(request_time))
+            request_time = float(request_time)
+        except ValueError:
+            errors.add(line, n_lines)
+        else:
+            yield url, request_time, line[time_start:time_end]
+    errors.finish(n_lines)
+
+
+PARSERS = {
+    "fast": fast_parse_lines,
+    "regex": regex_parse_lines
+}
+
+
+def parse_lines(log_lines, errors_limit, parser="fast", stats=None):
+    return PARSERS[parser](log_lines, errors_limit, stats)
+
+
+def parse_log(path, errors_limit, parser="fast", gzip_backend="auto", stats=None):
+    return parse_lines(xreadlines(path, gzip_backend), errors_limit, parser, stats)
 
 
 def median(lst):
@@ -115,46 +500,1314 @@ def median(lst):
     return float(sum(lst[quotient - 1:quotient + 1]) / 2)
 
 
-def analyze_log(log_dict, report_size):
-    urls = collections.defaultdict(list)
+class UrlNormalizer(object):
+    def __init__(self, drop_query=False, numeric_ids=False, templates=(), cache_size=URL_CACHE_SIZE):
+        self.drop_query = drop_query
+        self.numeric_ids = numeric_ids
+        self.cache_size = cache_size
+        self.cache = {}
+        self.template_specs = [[pattern, replacement] for pattern, replacement in templates]
+        # templates are indexed by the first path segment of their literal prefix, so a url is checked only
+        # against templates that can match it; a template whose literal prefix doesn't end at "/" or "$" can match
+        # a longer segment too ("^/api" matches "/apiv2/"), it is checked against every url
+        self.templates = collections.defaultdict(list)
+        for pattern, replacement in templates:
+            self.templates[self._get_prefix_key(pattern)].append((re.compile(pattern), replacement))
+
+    @staticmethod
+    def _get_prefix_key(pattern):
+        prefix = []
+        for char in pattern.lstrip("^"):
+            if (char == "/" or char == "$") and prefix:
+                return "".join(prefix)
+            if char in REGEX_SPECIAL_CHARS:
+                return ""
+            prefix.append(char)
+        return ""
+
+    def _get_templates(self, path):
+        segment_end = path.find("/", 1)
+        key = path[:segment_end] if segment_end != -1 else path
+        return self.templates.get(key, []) + self.templates.get("", [])
+
+    def normalize(self, url):
+        path, separator, query = url.partition("?")
+        for pattern, replacement in self._get_templates(path):
+            match = pattern.match(path)
+            if match:
+                path = match.expand(replacement) + path[match.end():]
+                break
+        else:
+            if self.numeric_ids:
+                path = NUMERIC_SEGMENT.sub("{id}", path)
+        if self.drop_query:
+            return path
+        return path + separator + query
+
+    def get_params(self):
+        return {"drop_query": self.drop_query, "numeric_ids": self.numeric_ids, "templates": self.template_specs}
+
+    def __call__(self, url):
+        normalized = self.cache.get(url)
+        if normalized is None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            normalized = self.cache[url] = self.normalize(url)
+        return normalized
+
+
+def get_url_normalizer(config_file):
+    drop_query, numeric_ids = config_file["URL_DROP_QUERY"], config_file["URL_NUMERIC_IDS"]
+    templates = config_file["URL_TEMPLATES"]
+    if not (drop_query or numeric_ids or templates):
+        return None
+    return UrlNormalizer(drop_query, numeric_ids, templates)
+
+
+class ExactQuantiles(object):
+    mode = "exact"
+
+    def __init__(self):
+        self.values = array.array('d')
+        self.is_sorted = True
+
+    def add(self, value):
+        self.values.append(value)
+        self.is_sorted = False
+
+    def add_many(self, values):
+        self.values.extend(values)
+        self.is_sorted = False
+
+    def merge(self, other):
+        self.values.extend(other.values)
+        self.is_sorted = False
+
+    def _sorted(self):
+        if not self.is_sorted:
+            self.values = array.array('d', sorted(self.values))
+            self.is_sorted = True
+        return self.values
+
+    def median(self):
+        return median(self._sorted())
+
+    def percentile(self, p):
+        values = self._sorted()
+        return values[get_rank(p, len(values)) - 1]
+
+    def to_dict(self):
+        return {"mode": self.mode, "values": base64.b64encode(self.values.tostring())}
+
+    @classmethod
+    def from_dict(cls, data):
+        quantiles = cls()
+        quantiles.values.fromstring(base64.b64decode(data["values"]))
+        quantiles.is_sorted = False
+        return quantiles
+
+
+class KLLQuantiles(object):
+    # KLL sketch: a stack of compactors, items promoted from level h carry weight 2 ** h
+    mode = "approx"
+
+    def __init__(self, k=SKETCH_SIZE):
+        self.k = k
+        self.compactors = [[]]
+        self.size = 0
+        self.max_size = self._capacity(0)
+
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * (2.0 / 3) ** depth)) + 1
+
+    def _grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self._capacity(level) for level in xrange(len(self.compactors)))
+
+    def _compress(self):
+        for level in xrange(len(self.compactors)):
+            items = self.compactors[level]
+            if len(items) >= self._capacity(level):
+                if level + 1 >= len(self.compactors):
+                    self._grow()
+                items.sort()
+                rest = [items.pop()] if len(items) % 2 else []
+                self.compactors[level + 1].extend(items[random.randint(0, 1)::2])
+                self.compactors[level] = rest
+                self.size = sum(len(c) for c in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.size += 1
+        if self.size >= self.max_size:
+            self._compress()
+
+    def add_many(self, values):
+        for value in values:
+            self.add(value)
 
-    for log_line in log_dict:
-        urls[log_line.get("request")].append(log_line["request_time"])
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self._compress()
 
-    total_requests_count = total_requests_time = 0
-    for v in urls.itervalues():
-        total_requests_count += len(v)
-        total_requests_time += sum(v)
+    def quantile(self, q):
+        weighted = sorted((value, 2 ** level) for level, items in enumerate(self.compactors) for value in items)
+        rank = q * sum(weight for _, weight in weighted)
+        accumulated = 0
+        for value, weight in weighted:
+            accumulated += weight
+            if accumulated >= rank:
+                return value
+        return weighted[-1][0]
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def percentile(self, p):
+        return self.quantile(p / 100.0)
+
+    def to_dict(self):
+        return {"mode": self.mode, "k": self.k, "compactors": self.compactors}
+
+    @classmethod
+    def from_dict(cls, data):
+        quantiles = cls(data["k"])
+        for _ in xrange(len(data["compactors"]) - 1):
+            quantiles._grow()
+        quantiles.compactors = data["compactors"]
+        quantiles.size = sum(len(c) for c in quantiles.compactors)
+        return quantiles
+
+
+class LatencyHistogram(object):
+    # fixed log-scaled buckets: a percentile is reported as the geometric middle of its bucket,
+    # so the relative error is bounded by the bucket growth whatever the number of values
+    mode = "histogram"
+
+    def __init__(self):
+        self.counts = array.array('l', [0]) * (len(HISTOGRAM_BOUNDS) + 1)
+        self.size = 0
+        self.max_value = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_right(HISTOGRAM_BOUNDS, value)] += 1
+        self.size += 1
+        if value > self.max_value:
+            self.max_value = value
+
+    def add_many(self, values):
+        # one sort and two searches per non-empty bucket instead of a bucket search per value
+        values = sorted(values)
+        if not values:
+            return
+        counts, previous, size = self.counts, 0, len(values)
+        while previous < size:
+            bucket = bisect.bisect_right(HISTOGRAM_BOUNDS, values[previous])
+            if bucket == len(HISTOGRAM_BOUNDS):
+                counts[bucket] += size - previous
+                break
+            position = bisect.bisect_left(values, HISTOGRAM_BOUNDS[bucket], previous)
+            counts[bucket] += position - previous
+            previous = position
+        self.size += size
+        if values[-1] > self.max_value:
+            self.max_value = values[-1]
+
+    def merge(self, other):
+        counts = self.counts
+        for bucket, count in enumerate(other.counts):
+            if count:
+                counts[bucket] += count
+        self.size += other.size
+        self.max_value = max(self.max_value, other.max_value)
+
+    @staticmethod
+    def get_bucket_value(bucket):
+        if bucket == 0:
+            return 0.0
+        if bucket == len(HISTOGRAM_BOUNDS):
+            return HISTOGRAM_BOUNDS[-1]
+        return math.sqrt(HISTOGRAM_BOUNDS[bucket - 1] * HISTOGRAM_BOUNDS[bucket])
+
+    def percentile(self, p):
+        rank = get_rank(p, self.size)
+        accumulated = 0
+        for bucket, count in enumerate(self.counts):
+            accumulated += count
+            if accumulated >= rank:
+                return min(self.get_bucket_value(bucket), self.max_value)
+        return 0.0
+
+    def median(self):
+        return self.percentile(50)
+
+    def to_dict(self):
+        return {
+            "mode": self.mode,
+            "buckets": [(bucket, count) for bucket, count in enumerate(self.counts) if count],
+            "max_value": self.max_value
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        for bucket, count in data["buckets"]:
+            histogram.counts[bucket] = count
+        histogram.size = sum(histogram.counts)
+        histogram.max_value = data["max_value"]
+        return histogram
+
+
+QUANTILE_MODES = {
+    "exact": ExactQuantiles,
+    "approx": KLLQuantiles,
+    "histogram": LatencyHistogram
+}
+# exact quantiles keep every request time, so cached day aggregates keep a histogram instead:
+# a month of them is loaded and merged in seconds
+CACHED_QUANTILE_MODES = {
+    "exact": "histogram"
+}
+
+
+def get_cached_quantile_mode(quantile_mode):
+    return CACHED_QUANTILE_MODES.get(quantile_mode, quantile_mode)
+
+
+def get_aggregates_params(quantile_mode, normalizer=None, timeline=False):
+    # saved with cached aggregates and checkpoints, which are built again when the settings change
+    return {"quantile_mode": quantile_mode, "normalizer": normalizer.get_params() if normalizer is not None else None,
+            "timeline": timeline}
+
+
+def get_rank(p, size):
+    # nearest-rank percentile in integer arithmetic, so every engine picks the same value
+    return max((p * size + 99) // 100, 1)
+
+
+class LogAggregates(object):
+    # per-URL state is kept in parallel arrays indexed by url id
+    def __init__(self, quantile_mode="exact"):
+        self.quantile_mode = quantile_mode
+        self.url_ids = {}
+        self.urls = []
+        self.counts = array.array('l')
+        self.time_sums = array.array('d')
+        self.time_maxes = array.array('d')
+        self.quantiles = []
+        # latency histograms of all urls per minute (unix time), the timeline of the report
+        self.timeline = {}
+        # corrupted lines skipped by the parser
+        self.n_errors = 0
+
+    def __len__(self):
+        return len(self.urls)
+
+    def get_url_id(self, url):
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.url_ids[url] = len(self.urls)
+            self.urls.append(url)
+            self.counts.append(0)
+            self.time_sums.append(0)
+            self.time_maxes.append(0)
+            self.quantiles.append(QUANTILE_MODES[self.quantile_mode]())
+        return url_id
+
+    def get_minute_histogram(self, minute):
+        histogram = self.timeline.get(minute)
+        if histogram is None:
+            histogram = self.timeline[minute] = LatencyHistogram()
+        return histogram
+
+    def add(self, url, request_time):
+        self.add_by_id(self.get_url_id(url), request_time)
+
+    def add_by_id(self, url_id, request_time):
+        self.counts[url_id] += 1
+        self.time_sums[url_id] += request_time
+        if request_time > self.time_maxes[url_id]:
+            self.time_maxes[url_id] = request_time
+        self.quantiles[url_id].add(request_time)
+
+    def add_many(self, url, request_times):
+        # the same state as add called for every request time: reduce sums left to right, as the running sum does
+        url_id = self.get_url_id(url)
+        self.counts[url_id] += len(request_times)
+        self.time_sums[url_id] = reduce(operator.add, request_times, self.time_sums[url_id])
+        self.time_maxes[url_id] = max(self.time_maxes[url_id], max(request_times))
+        self.quantiles[url_id].add_many(request_times)
+
+    def merge(self, other):
+        for other_id, url in enumerate(other.urls):
+            url_id = self.get_url_id(url)
+            self.counts[url_id] += other.counts[other_id]
+            self.time_sums[url_id] += other.time_sums[other_id]
+            self.time_maxes[url_id] = max(self.time_maxes[url_id], other.time_maxes[other_id])
+            self.quantiles[url_id].merge(other.quantiles[other_id])
+        for minute, histogram in other.timeline.iteritems():
+            self.get_minute_histogram(minute).merge(histogram)
+        self.n_errors += other.n_errors
+        return self
+
+    def to_dict(self):
+        return {
+            "quantile_mode": self.quantile_mode,
+            "urls": self.urls,
+            "counts": self.counts.tolist(),
+            "time_sums": self.time_sums.tolist(),
+            "time_maxes": self.time_maxes.tolist(),
+            "quantiles": [quantiles.to_dict() for quantiles in self.quantiles],
+            "timeline": [(minute, histogram.to_dict()) for minute, histogram in self.timeline.iteritems()],
+            "n_errors": self.n_errors
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        aggregates = cls(data["quantile_mode"])
+        aggregates.urls = data["urls"]
+        aggregates.url_ids = {url: url_id for url_id, url in enumerate(aggregates.urls)}
+        aggregates.counts.extend(data["counts"])
+        aggregates.time_sums.extend(data["time_sums"])
+        aggregates.time_maxes.extend(data["time_maxes"])
+        aggregates.quantiles = [QUANTILE_MODES[q["mode"]].from_dict(q) for q in data["quantiles"]]
+        # aggregates saved before the timeline was introduced have none
+        aggregates.timeline = {minute: LatencyHistogram.from_dict(histogram)
+                               for minute, histogram in data.get("timeline", [])}
+        aggregates.n_errors = data.get("n_errors", 0)
+        return aggregates
+
+
+def parse_minute_local(minute_local):
+    # "29/Jun/2017:03:50 +0300" is time_local without seconds
+    try:
+        return parse_time_local(minute_local[:17] + ":00" + minute_local[17:])
+    except (IndexError, ValueError):
+        return None
+
+
+class TimelineBuffer(object):
+    # log lines come in time order, so request times are buffered until the minute changes
+    # and every minute histogram is filled at once; get_minute converts the key of a minute
+    # to unix time then, once per minute
+    def __init__(self, urls, get_minute=None):
+        self.urls = urls
+        self.get_minute = get_minute
+        self.minute = None
+        self.times = array.array('d')
+
+    def get_buffer(self, minute):
+        if minute != self.minute:
+            self.flush()
+            self.minute = minute
+        return self.times
+
+    def flush(self):
+        if self.minute is not None and self.times:
+            minute = self.minute if self.get_minute is None else self.get_minute(self.minute)
+            if minute is not None:
+                self.urls.get_minute_histogram(minute).add_many(self.times)
+        self.times = array.array('d')
+
+
+def aggregate_log(records, quantile_mode="exact", normalizer=None, timeline=False, batch_size=LINES_PER_TASK):
+    # request times of a batch of lines are grouped by url, so a line costs a dict lookup and an append,
+    # and the state of a url is updated once per batch in the order the urls are first seen
+    urls = LogAggregates(quantile_mode)
+    records = iter(records)
+    timeline_buffer = TimelineBuffer(urls, parse_minute_local)
+    last_time_local = last_minute_local = append = None
+    while True:
+        times_by_url, batch_urls = {}, []
+        if not timeline:
+            for url, request_time, time_local in itertools.islice(records, batch_size):
+                try:
+                    times_by_url[url].append(request_time)
+                except KeyError:
+                    times_by_url[url] = [request_time]
+                    batch_urls.append(url)
+        else:
+            for url, request_time, time_local in itertools.islice(records, batch_size):
+                try:
+                    times_by_url[url].append(request_time)
+                except KeyError:
+                    times_by_url[url] = [request_time]
+                    batch_urls.append(url)
+                if time_local != last_time_local:
+                    last_time_local = time_local
+                    # no datetime work per line: the minute is a slice of time_local until the buffer is flushed
+                    minute_local = time_local[:17] + time_local[20:]
+                    if minute_local != last_minute_local:
+                        last_minute_local = minute_local
+                        append = timeline_buffer.get_buffer(minute_local).append
+                append(request_time)
+        if not batch_urls:
+            break
+        for url in batch_urls:
+            urls.add_many(url if normalizer is None else normalizer(url), times_by_url[url])
+    timeline_buffer.flush()
+    return urls
+
+
+def dump_aggregates(urls):
+    return urls.to_dict()
+
+
+def load_aggregates(data):
+    return LogAggregates.from_dict(data)
+
+
+def merge_aggregates(target, source):
+    return target.merge(source)
+
+
+def build_report(urls, report_size):
+    total_requests_count = sum(urls.counts)
+    total_requests_time = sum(urls.time_sums)
+
+    # only the top report_size urls by time_sum get their full stats computed
+    top_url_ids = heapq.nlargest(report_size, xrange(len(urls)), key=urls.time_sums.__getitem__)
 
     report_data = []
-    for url, times_list in urls.iteritems():
-        times_list.sort()
-        report_data.append({
-            'url': url,
-            'count': len(times_list),
-            'count_perc': round(100 * len(times_list) / float(total_requests_count), 3),
-            'time_sum': round(sum(times_list), 3),
-            'time_perc': round(100 * sum(times_list) / total_requests_time, 3),
-            'time_avg': round(sum(times_list) / len(times_list), 3),
-            'time_max': round(max(times_list), 3),
-            'time_med': round(median(times_list), 3)
-        })
-
-    report_data.sort(key=lambda x: x['time_sum'], reverse=True)
-    return report_data[:report_size]
-
-
-def save_report(path, report_template, report_date, data):
+    for url_id in top_url_ids:
+        count, time_sum = urls.counts[url_id], urls.time_sums[url_id]
+        quantiles = urls.quantiles[url_id]
+        row = {
+            'url': urls.urls[url_id],
+            'count': count,
+            'count_perc': round(100 * count / float(total_requests_count), 3),
+            'time_sum': round(time_sum, 3),
+            'time_perc': round(100 * time_sum / total_requests_time, 3),
+            'time_avg': round(time_sum / count, 3),
+            'time_max': round(urls.time_maxes[url_id], 3),
+            'time_med': round(quantiles.median(), 3)
+        }
+        for p in REPORT_PERCENTILES:
+            row['time_p{}'.format(p)] = round(quantiles.percentile(p), 3)
+        report_data.append(row)
+    return report_data
+
+
+def build_timeline(timeline, resolution="hour"):
+    # a null TIMELINE_RESOLUTION turns the timeline off
+    if resolution is None:
+        return []
+    step = TIMELINE_RESOLUTIONS[resolution]
+    histograms = collections.defaultdict(LatencyHistogram)
+    for minute, histogram in timeline.iteritems():
+        histograms[minute - minute % step].merge(histogram)
+
+    timeline_data = []
+    for start in sorted(histograms):
+        histogram = histograms[start]
+        row = {
+            'time': datetime.fromtimestamp(start).strftime("%Y.%m.%d %H:%M"),
+            'count': histogram.size,
+            'time_max': round(histogram.max_value, 3),
+            'time_med': round(histogram.median(), 3)
+        }
+        for p in REPORT_PERCENTILES:
+            row['time_p{}'.format(p)] = round(histogram.percentile(p), 3)
+        timeline_data.append(row)
+    return timeline_data
+
+
+def analyze_log(records, report_size, quantile_mode="exact", normalizer=None):
+    return build_report(aggregate_log(records, quantile_mode, normalizer), report_size)
+
+
+def get_aggregator(engine):
+    return numpy_aggregate_log if engine == "numpy" else aggregate_log
+
+
+def aggregate_part(lines, quantile_mode, parser, normalizer, timeline, engine):
+    # a part of a parallel run, the errors limit is applied to the whole run by the main process
+    errors = ErrorCounter(None)
+    urls = get_aggregator(engine)(parse_lines(lines, errors, parser), quantile_mode, normalizer, timeline)
+    urls.n_errors = errors.n_errors
+    return urls, errors.n_lines, errors.samples
+
+
+def aggregate_chunk(path, start, end, quantile_mode, parser, normalizer, timeline, engine):
+    return aggregate_part(xreadlines_range(path, start, end), quantile_mode, parser, normalizer, timeline, engine)
+
+
+def aggregate_lines(lines, errors_limit, quantile_mode, parser, normalizer, timeline=False):
+    stats = collections.Counter()
+    urls = aggregate_log(parse_lines(lines, errors_limit, parser, stats), quantile_mode, normalizer, timeline)
+    urls.n_errors = stats["errors"]
+    return urls
+
+
+def track_progress(records, progress, stats=None, batch_size=LINES_PER_TASK):
+    # progress is called with the number of lines read since the last call, the corrupted lines counted
+    # in stats included
+    records = iter(records)
+    n_errors = 0
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        n_lines = len(batch)
+        if stats is not None:
+            n_lines += stats["errors"] - n_errors
+            n_errors = stats["errors"]
+        if n_lines:
+            progress(n_lines)
+        if not batch:
+            return
+        for record in batch:
+            yield record
+
+
+def iter_batches(lines, batch_size):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ignore_interrupts():
+    # ctrl-c stops the main process only, it terminates the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+@contextlib.contextmanager
+def worker_pool(workers, pool=None):
+    # a warm pool of the watch mode is shared between runs and stays open
+    if pool is not None or workers <= 1:
+        yield pool
+        return
+    pool = multiprocessing.Pool(workers, ignore_interrupts)
+    try:
+        yield pool
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def aggregate_log_parallel(path, errors_limit, workers, quantile_mode="exact", parser="fast", normalizer=None,
+                           gzip_backend="auto", progress=None, pool=None, timeline=False, engine="python"):
+    urls = LogAggregates(quantile_mode)
+    errors = ErrorCounter(errors_limit)
+
+    def merge(result):
+        part, n_lines, samples = result
+        errors.merge(part.n_errors, n_lines, samples)
+        merge_aggregates(urls, part)
+        if progress is not None:
+            progress(n_lines)
+
+    with worker_pool(workers, pool) as pool:
+        if path.endswith(".gz"):
+            # decompression stays in the main process, parsing is fed to the workers
+            # with a bounded number of in-flight batches to keep memory flat
+            pending = collections.deque()
+            for batch in iter_batches(xreadlines(path, gzip_backend), LINES_PER_TASK):
+                pending.append(pool.apply_async(aggregate_part, (batch, quantile_mode, parser, normalizer, timeline,
+                                                                 engine)))
+                if len(pending) >= 2 * workers:
+                    merge(pending.popleft().get())
+            while pending:
+                merge(pending.popleft().get())
+        else:
+            results = [pool.apply_async(aggregate_chunk, (path, start, end, quantile_mode, parser, normalizer,
+                                                          timeline, engine))
+                       for start, end in get_chunks(path, workers)]
+            for result in results:
+                merge(result.get())
+    errors.finish(errors.n_lines)
+    return urls
+
+
+def aggregate_file(path, errors_limit, workers=1, quantile_mode="exact", parser="fast", normalizer=None,
+                   gzip_backend="auto", progress=None, pool=None, timeline=False, engine="python"):
+    if workers > 1:
+        return aggregate_log_parallel(path, errors_limit, workers, quantile_mode, parser, normalizer, gzip_backend,
+                                      progress, pool, timeline, engine)
+    stats = collections.Counter()
+    records = parse_log(path, errors_limit, parser, gzip_backend, stats)
+    if progress is not None:
+        records = track_progress(records, progress, stats)
+    urls = get_aggregator(engine)(records, quantile_mode, normalizer, timeline)
+    urls.n_errors = stats["errors"]
+    return urls
+
+
+def get_log_files_in_range(log_dir, name_pattern, date_from, date_to):
+    log_files = []
+    for path in glob.glob(os.path.join(log_dir, name_pattern)):
+        dates = LOG_DATE_PATTERN.findall(path)
+        if dates and date_from <= dates[0] <= date_to:
+            log_files.append((dates[0], path))
+    # one file per day: with delaycompress log-20170529 and log-20170529.gz may both exist, the first one is taken,
+    # as LogIndex.get_pending does
+    days = collections.OrderedDict()
+    for log_date, path in sorted(log_files):
+        days.setdefault(log_date, path)
+    return days.items()
+
+
+def load_cached_aggregates(path, params):
+    if not os.path.isfile(path):
+        return None
+    try:
+        with gzip.open(path, 'rb') as f:
+            data = json.load(f)
+        if data.get("params") != params:
+            logging.info("Aggregates {} were built with other settings. Building them again.".format(path))
+            return None
+        return load_aggregates(data["urls"])
+    except (IOError, EOFError, ValueError, KeyError, AttributeError, zlib.error) as error:
+        logging.info("Aggregates {} are corrupted. Building them again.\n{}".format(path, error))
+        return None
+
+
+def get_day_aggregates(path, log_date, aggregates_dir, errors_limit, workers=1, quantile_mode="exact",
+                       parser="fast", normalizer=None, gzip_backend="auto", progress=None, pool=None, stats=None,
+                       timeline=False):
+    # stats count the files, bytes and corrupted lines that are parsed, a cached day is not counted
+    quantile_mode = get_cached_quantile_mode(quantile_mode)
+    params = get_aggregates_params(quantile_mode, normalizer, timeline)
+    aggregate_path = os.path.join(aggregates_dir, "aggregate-{}.json.gz".format(log_date))
+    urls = load_cached_aggregates(aggregate_path, params)
+    if urls is not None:
+        return urls
+
+    logging.info("Aggregating log file: {}".format(path))
+    urls = aggregate_file(path, errors_limit, workers, quantile_mode, parser, normalizer, gzip_backend, progress,
+                          pool, timeline)
+    if stats is not None:
+        stats["files"] += 1
+        stats["bytes"] += os.path.getsize(path)
+        stats["errors"] += urls.n_errors
+    if not os.path.isdir(aggregates_dir):
+        os.makedirs(aggregates_dir)
+    tmp_path = aggregate_path + ".tmp"
+    with gzip.open(tmp_path, 'wb') as f:
+        json.dump({"params": params, "urls": dump_aggregates(urls)}, f)
+    os.rename(tmp_path, aggregate_path)
+    return urls
+
+
+def aggregate_range(log_files, aggregates_dir, errors_limit, workers=1, quantile_mode="exact", parser="fast",
+                    normalizer=None, gzip_backend="auto", progress=None, pool=None, stats=None, timeline=False):
+    urls = LogAggregates(get_cached_quantile_mode(quantile_mode))
+    for log_date, path in log_files:
+        merge_aggregates(urls, get_day_aggregates(path, log_date, aggregates_dir, errors_limit, workers,
+                                                  quantile_mode, parser, normalizer, gzip_backend, progress, pool,
+                                                  stats, timeline))
+    return urls
+
+
+def expand_log_dirs(patterns):
+    log_dirs = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isdir(path) and path not in log_dirs:
+                log_dirs.append(path)
+    return log_dirs
+
+
+def get_host_names(log_dirs):
+    # a host is named by the path components that differ between the log dirs: /var/log/web1/nginx -> web1
+    parts = [os.path.abspath(log_dir).strip(os.sep).split(os.sep) for log_dir in log_dirs]
+    if len(parts) == 1:
+        parts = [parts[0][-1:]]
+    for index in (0, -1):
+        while all(len(p) > 1 for p in parts) and len(set(p[index] for p in parts)) == 1:
+            parts = [p[1:] if index == 0 else p[:-1] for p in parts]
+    return dict(zip(log_dirs, ("_".join(p) for p in parts)))
+
+
+class LogIndex(object):
+    # known rotated log files of every host: date, size, mtime and whether the file is processed;
+    # a directory is listed again only when its mtime changes, and only new names are matched
+    def __init__(self, path):
+        self.path = path
+        self.hosts = {}
+        try:
+            with open(path, 'r') as f:
+                self.hosts = json.load(f)["hosts"]
+        except IOError:
+            pass
+        except (ValueError, KeyError) as error:
+            logging.info("Index file {} is corrupted. Scanning log dirs from scratch.\n{}".format(path, error))
+
+    def scan(self, host, log_dir, name_pattern):
+        entry = self.hosts.get(host)
+        if entry is None or entry["dir"] != log_dir or entry["pattern"] != name_pattern:
+            entry = self.hosts[host] = {"dir": log_dir, "pattern": name_pattern, "mtime": None, "files": {}}
+        mtime = os.stat(log_dir).st_mtime
+        if entry["mtime"] == mtime:
+            return
+        files = entry["files"]
+        names = set(fnmatch.filter(os.listdir(log_dir), name_pattern))
+        for name in set(files) - names:
+            del files[name]
+        for name in names:
+            if name in files and files[name]["processed"]:
+                continue
+            dates = LOG_DATE_PATTERN.findall(name) if name not in files else [files[name]["date"]]
+            stat = os.stat(os.path.join(log_dir, name))
+            # a file that failed is retried once it changes
+            failed = name in files and files[name].get("failed") and \
+                (files[name]["size"], files[name]["mtime"]) == (stat.st_size, stat.st_mtime)
+            files[name] = {"date": dates[0] if dates else None, "size": stat.st_size, "mtime": stat.st_mtime,
+                           "processed": False, "failed": bool(failed)}
+        entry["mtime"] = mtime
+
+    def get_pending(self):
+        # one file per host and day: a day processed from log-20170630 is not repeated for log-20170630.gz
+        pending = []
+        for host, entry in sorted(self.hosts.iteritems()):
+            processed = set(info["date"] for info in entry["files"].itervalues() if info["processed"])
+            for name, info in sorted(entry["files"].iteritems()):
+                if info["processed"] or info.get("failed") or info["date"] is None:
+                    continue
+                if info["date"] in processed:
+                    info["processed"] = True
+                    continue
+                processed.add(info["date"])
+                pending.append((host, info["date"], os.path.join(entry["dir"], name)))
+        return pending
+
+    def get_processed(self, log_date):
+        processed = {}
+        for host, entry in self.hosts.iteritems():
+            for name, info in sorted(entry["files"].iteritems()):
+                if info["processed"] and info["date"] == log_date:
+                    processed.setdefault(host, os.path.join(entry["dir"], name))
+        return sorted(processed.iteritems())
+
+    def mark_processed(self, host, path):
+        self.hosts[host]["files"][os.path.basename(path)]["processed"] = True
+
+    def mark_failed(self, host, path):
+        self.hosts[host]["files"][os.path.basename(path)]["failed"] = True
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"hosts": self.hosts}, f)
+        os.rename(tmp_path, self.path)
+
+
+def aggregate_host_file(task):
+    # a file of one host is aggregated by one worker, a corrupted or truncated file does not stop the other hosts
+    host, log_date, path, aggregates_dir, errors_limit, quantile_mode, parser, normalizer, gzip_backend, \
+        timeline = task
+    stats = collections.Counter()
+    try:
+        urls = get_day_aggregates(path, log_date, os.path.join(aggregates_dir, host), errors_limit, 1,
+                                  quantile_mode, parser, normalizer, gzip_backend, stats=stats, timeline=timeline)
+    except (RuntimeError, EnvironmentError, EOFError, zlib.error) as error:
+        return host, log_date, path, None, str(error) or error.__class__.__name__, stats
+    return host, log_date, path, urls, None, stats
+
+
+def aggregate_hosts(pending, aggregates_dir, errors_limit, workers=1, quantile_mode="exact", parser="fast",
+                    normalizer=None, gzip_backend="auto", progress=None, pool=None, stats=None, timeline=False):
+    tasks = [(host, log_date, path, aggregates_dir, errors_limit, quantile_mode, parser, normalizer, gzip_backend,
+              timeline) for host, log_date, path in pending]
+    with worker_pool(workers, pool) as pool:
+        results = pool.imap_unordered(aggregate_host_file, tasks) if pool else itertools.imap(aggregate_host_file,
+                                                                                              tasks)
+        for result in results:
+            urls, file_stats = result[3], result[5]
+            if stats is not None:
+                stats.update(file_stats)
+            if progress is not None and urls is not None and file_stats["files"]:
+                progress(sum(urls.counts) + urls.n_errors)
+            yield result[:5]
+
+
+def get_host_report_date(host, log_date):
+    return "{}-{}".format(host, get_report_date(log_date))
+
+
+def get_index_path(ts_file):
+    return os.path.splitext(ts_file)[0] + ".index.json"
+
+
+class ColumnWriter(object):
+    def __init__(self, path, batch_size=LINES_PER_TASK):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.batch_size = batch_size
+        self.size = 0
+        self.columns = {name: array.array(typecode) for name, typecode in COLUMNS}
+        self.files = {name: open(os.path.join(path, name + ".bin"), 'wb') for name, _ in COLUMNS}
+        self.dictionaries = {name: {} for name in DICTIONARY_COLUMNS}
+
+    def encode(self, name, value):
+        codes = self.dictionaries[name]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+        return code
+
+    def add(self, url, status, user_agent, request_time_ms, timestamp):
+        columns = self.columns
+        columns["url"].append(self.encode("url", url))
+        columns["status"].append(self.encode("status", status))
+        columns["user_agent"].append(self.encode("user_agent", user_agent))
+        columns["request_time_ms"].append(request_time_ms)
+        columns["timestamp"].append(timestamp)
+        self.size += 1
+        if len(columns["url"]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for name, column in self.columns.iteritems():
+            column.tofile(self.files[name])
+            del column[:]
+
+    def close(self):
+        self.flush()
+        for f in self.files.itervalues():
+            f.close()
+        meta = {
+            "size": self.size,
+            "byteorder": sys.byteorder,
+            "columns": {name: {"typecode": typecode, "itemsize": array.array(typecode).itemsize}
+                        for name, typecode in COLUMNS},
+            "dictionaries": {name: sorted(codes, key=codes.get) for name, codes in self.dictionaries.iteritems()}
+        }
+        # meta.json is written last, its presence marks a complete export
+        with open(os.path.join(self.path, "meta.json"), 'w') as f:
+            json.dump(meta, f)
+
+
+def parse_time_local(value):
+    local_time, offset = value.split(" ")
+    timestamp = calendar.timegm(time.strptime(local_time, "%d/%b/%Y:%H:%M:%S"))
+    offset_seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+    return timestamp - offset_seconds if offset[0] == "+" else timestamp + offset_seconds
+
+
+def export_log(path, export_dir, errors_limit, gzip_backend="auto"):
+    writer = ColumnWriter(export_dir)
+    errors = ErrorCounter(errors_limit)
+    timestamps = {}
+    n_lines = 0
+    for n_lines, line in enumerate(xreadlines(path, gzip_backend), 1):
+        try:
+            request, status, user_agent, request_time, time_local = LOG_LINE_PATTERN.match(line).group(
+                "request", "status", "http_user_agent", "request_time", "time_local")
+            url = request.split(" ")[1]
+            timestamp = timestamps.get(time_local)
+            if timestamp is None:
+                if len(timestamps) >= URL_CACHE_SIZE:
+                    timestamps.clear()
+                timestamp = timestamps[time_local] = parse_time_local(time_local)
+        except (AttributeError, IndexError, ValueError):
+            errors.add(line, n_lines)
+        else:
+            writer.add(url, status, user_agent, int(round(float(request_time) * 1000)), timestamp)
+    errors.finish(n_lines)
+    writer.close()
+
+
+def load_columns_meta(path):
+    with open(os.path.join(path, "meta.json"), 'r') as f:
+        return json.load(f)
+
+
+def get_column_dtype(meta, name):
+    column_meta = meta["columns"][name]
+    byteorder = "<" if meta["byteorder"] == "little" else ">"
+    return numpy.dtype(str(column_meta["typecode"])).newbyteorder(byteorder)
+
+
+def load_columns(path):
+    meta = load_columns_meta(path)
+    columns = {}
+    for name, column_meta in meta["columns"].iteritems():
+        column = array.array(str(column_meta["typecode"]))
+        if column.itemsize != column_meta["itemsize"]:
+            raise RuntimeError("Column {} was exported on a platform with another item size.".format(name))
+        with open(os.path.join(path, name + ".bin"), 'rb') as f:
+            column.fromfile(f, meta["size"])
+        if meta["byteorder"] != sys.byteorder:
+            column.byteswap()
+        columns[name] = column
+    return meta, columns
+
+
+def aggregate_columns(path, quantile_mode="exact", normalizer=None, timeline=False):
+    meta, columns = load_columns(path)
+    urls = LogAggregates(quantile_mode)
+    dictionary = meta["dictionaries"]["url"]
+    if normalizer is not None:
+        dictionary = [normalizer(url) for url in dictionary]
+    url_ids = [urls.get_url_id(url) for url in dictionary]
+    add_by_id = urls.add_by_id
+    if not timeline:
+        for url_code, request_time_ms in itertools.izip(columns["url"], columns["request_time_ms"]):
+            add_by_id(url_ids[url_code], request_time_ms / 1000.0)
+        return urls
+    timeline_buffer = TimelineBuffer(urls)
+    last_timestamp = append = None
+    for url_code, request_time_ms, timestamp in itertools.izip(columns["url"], columns["request_time_ms"],
+                                                               columns["timestamp"]):
+        request_time = request_time_ms / 1000.0
+        add_by_id(url_ids[url_code], request_time)
+        if timestamp != last_timestamp:
+            last_timestamp = timestamp
+            append = timeline_buffer.get_buffer(timestamp - timestamp % 60).append
+        append(request_time)
+    timeline_buffer.flush()
+    return urls
+
+
+def numpy_add_batch(urls, codes, times, minutes=None):
+    # codes are url ids of urls; counts, sums and maxes are reduced with bincount and reduceat and added
+    # to the arrays of urls in place, the request times of every url are passed to its quantiles at once
+    if not len(codes):
+        return
+    counts = numpy.bincount(codes, minlength=len(urls))
+    present = numpy.flatnonzero(counts)
+    present_counts = counts[present]
+    # bincount accumulates in input order, so a single batch sums as the python engine does
+    time_sums = numpy.bincount(codes, weights=times, minlength=len(urls))
+    order = numpy.argsort(codes, kind="mergesort")
+    grouped_times = times[order]
+    ends = numpy.cumsum(present_counts)
+    numpy.frombuffer(urls.counts, dtype=numpy.dtype('l'))[present] += present_counts
+    numpy.frombuffer(urls.time_sums, dtype=numpy.float64)[present] += time_sums[present]
+    time_maxes = numpy.frombuffer(urls.time_maxes, dtype=numpy.float64)
+    time_maxes[present] = numpy.maximum(time_maxes[present],
+                                        numpy.maximum.reduceat(grouped_times, ends - present_counts))
+    grouped_times = array.array('d', grouped_times.tostring())
+    quantiles, start = urls.quantiles, 0
+    for url_id, end in itertools.izip(present.tolist(), ends.tolist()):
+        quantiles[url_id].add_many(grouped_times[start:end])
+        start = end
+    if minutes is not None:
+        for minute, histogram in numpy_build_timeline(minutes, times).iteritems():
+            urls.get_minute_histogram(minute).merge(histogram)
+
+
+def numpy_get_codes(values, codes, get_code):
+    # codes of the values not seen yet are made by get_code in the order the values are first seen
+    values_codes = map(codes.get, values)
+    if None not in values_codes:
+        return values_codes
+    first_seen = dict(itertools.izip(reversed(values), xrange(len(values) - 1, -1, -1)))
+    for value in sorted(set(values).difference(codes), key=first_seen.__getitem__):
+        codes[value] = get_code(value)
+    return map(codes.__getitem__, values)
+
+
+def numpy_aggregate_log(records, quantile_mode="exact", normalizer=None, timeline=False, batch_size=LINES_PER_TASK):
+    # records are read in batches into preallocated arrays, which are reduced by numpy_add_batch;
+    # urls and time_local are coded per batch by dict lookups done in C, python runs once per new url or second
+    urls = LogAggregates(quantile_mode)
+    url_ids, minutes_by_time, minutes_by_minute_local = {}, {}, {}
+    codes = numpy.empty(batch_size, numpy.intp)
+    times = numpy.empty(batch_size)
+    minutes = numpy.empty(batch_size, numpy.int64)
+
+    def get_url_id(url):
+        return urls.get_url_id(url if normalizer is None else normalizer(url))
+
+    def get_minute(time_local):
+        # lines with an unparsable time_local are left out of the timeline
+        minute_local = time_local[:17] + time_local[20:]
+        minute = minutes_by_minute_local.get(minute_local)
+        if minute is None:
+            minute = minutes_by_minute_local[minute_local] = parse_minute_local(minute_local)
+            if minute is None:
+                minute = minutes_by_minute_local[minute_local] = -1
+        return minute
+
+    get_url, get_request_time, get_time_local = operator.itemgetter(0), operator.itemgetter(1), operator.itemgetter(2)
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return urls
+        size = len(batch)
+        # columns are taken by map in C, zip(*batch) is several times slower
+        codes[:size] = numpy_get_codes(map(get_url, batch), url_ids, get_url_id)
+        times[:size] = map(get_request_time, batch)
+        if timeline:
+            minutes[:size] = numpy_get_codes(map(get_time_local, batch), minutes_by_time, get_minute)
+        numpy_add_batch(urls, codes[:size], times[:size], minutes[:size] if timeline else None)
+
+
+def numpy_build_timeline(minutes, times):
+    known = minutes >= 0
+    minutes, times = minutes[known], times[known]
+    if not len(minutes):
+        return {}
+    unique_minutes, minute_codes = numpy.unique(minutes, return_inverse=True)
+    n_buckets = len(HISTOGRAM_BOUNDS) + 1
+    # searchsorted(side="right") puts every value into the same bucket as bisect_right
+    buckets = numpy.searchsorted(HISTOGRAM_BOUNDS, times, side="right")
+    counts = numpy.bincount(minute_codes * n_buckets + buckets,
+                            minlength=len(unique_minutes) * n_buckets).reshape(len(unique_minutes), n_buckets)
+    order = numpy.argsort(minute_codes, kind="mergesort")
+    starts = numpy.searchsorted(minute_codes[order], numpy.arange(len(unique_minutes)))
+    time_maxes = numpy.maximum.reduceat(times[order], starts)
+
+    timeline = {}
+    for minute, minute_counts, time_max in itertools.izip(unique_minutes.tolist(), counts, time_maxes.tolist()):
+        histogram = timeline[minute] = LatencyHistogram()
+        histogram.counts = array.array('l', minute_counts.tolist())
+        histogram.size = sum(histogram.counts)
+        histogram.max_value = time_max
+    return timeline
+
+
+def numpy_aggregate_columns(path, quantile_mode="exact", normalizer=None, timeline=False, batch_size=LINES_PER_TASK):
+    meta = load_columns_meta(path)
+    size = meta["size"]
+    codes = numpy.fromfile(os.path.join(path, "url.bin"), dtype=get_column_dtype(meta, "url"), count=size)
+    times = numpy.fromfile(os.path.join(path, "request_time_ms.bin"),
+                           dtype=get_column_dtype(meta, "request_time_ms"), count=size) / 1000.0
+    timestamps = numpy.fromfile(os.path.join(path, "timestamp.bin"), dtype=get_column_dtype(meta, "timestamp"),
+                                count=size)
+    urls = LogAggregates(quantile_mode)
+    dictionary = meta["dictionaries"]["url"]
+    if normalizer is not None:
+        dictionary = [normalizer(url) for url in dictionary]
+    url_ids = numpy.array([urls.get_url_id(url) for url in dictionary], dtype=numpy.intp)
+    for start in xrange(0, size, batch_size):
+        batch_timestamps = timestamps[start:start + batch_size]
+        numpy_add_batch(urls, url_ids[codes[start:start + batch_size]], times[start:start + batch_size],
+                        batch_timestamps - batch_timestamps % 60 if timeline else None)
+    return urls
+
+
+class LogTail(object):
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+
+    def __iter__(self):
+        # the last line may still be written by nginx, it is left for the next run
+        with open(self.path, 'rb') as log_file:
+            log_file.seek(self.offset)
+            for line in iter(log_file.readline, ''):
+                if not line.endswith("\n"):
+                    break
+                self.offset += len(line)
+                yield line
+
+
+def get_checkpoint_path(ts_file):
+    return os.path.splitext(ts_file)[0] + ".checkpoint"
+
+
+def load_checkpoint(path, params):
+    try:
+        with open(path, 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("params") != params:
+            logging.info("Checkpoint file {} was saved with other settings. Starting from scratch.".format(path))
+            return None
+        checkpoint["urls"] = load_aggregates(checkpoint["urls"])
+    except IOError:
+        return None
+    except (ValueError, KeyError, AttributeError) as error:
+        logging.info("Checkpoint file {} is corrupted. Starting from scratch.\n{}".format(path, error))
+        return None
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    data = dict(checkpoint, urls=dump_aggregates(checkpoint["urls"]))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+
+def find_file_by_inode(log_dir, inode):
+    for path in glob.glob(os.path.join(log_dir, "*")):
+        if os.stat(path).st_ino == inode:
+            return path
+    return None
+
+
+def follow_log(log_dir, live_log_name, checkpoint_path, errors_limit, quantile_mode="exact", parser="fast",
+               normalizer=None, timeline=False):
+    live_log_path = os.path.join(log_dir, live_log_name)
+    live_stat = os.stat(live_log_path)
+    params = get_aggregates_params(quantile_mode, normalizer, timeline)
+    checkpoint = load_checkpoint(checkpoint_path, params)
+    finished = None
+
+    is_rotated = checkpoint is not None and (checkpoint["inode"] != live_stat.st_ino or
+                                             checkpoint["offset"] > live_stat.st_size)
+    if is_rotated:
+        rotated_path = find_file_by_inode(log_dir, checkpoint["inode"])
+        if rotated_path is not None:
+            logging.info("Log was rotated to {}, finishing it.".format(rotated_path))
+            tail = LogTail(rotated_path, checkpoint["offset"])
+            merge_aggregates(checkpoint["urls"], aggregate_lines(tail, errors_limit, quantile_mode, parser,
+                                                                 normalizer, timeline))
+        else:
+            logging.info("Rotated log file is not found, its report is built from the checkpoint.")
+        finished = checkpoint
+        checkpoint = None
+
+    if checkpoint is None:
+        checkpoint = {
+            "inode": live_stat.st_ino,
+            "offset": 0,
+            "date": datetime.now().strftime("%Y.%m.%d"),
+            "params": params,
+            "urls": LogAggregates(quantile_mode)
+        }
+
+    tail = LogTail(live_log_path, checkpoint["offset"])
+    merge_aggregates(checkpoint["urls"], aggregate_lines(tail, errors_limit, quantile_mode, parser, normalizer,
+                                                         timeline))
+    checkpoint["offset"] = tail.offset
+    save_checkpoint(checkpoint_path, checkpoint)
+    return checkpoint, finished
+
+
+class BrotliFile(object):
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.compressor = brotli.Compressor()
+
+    def write(self, data):
+        self.file.write(self.compressor.process(data))
+
+    def close(self):
+        self.file.write(self.compressor.finish())
+        self.file.close()
+
+
+REPORT_COMPRESSIONS = {
+    "gzip": (".gz", lambda path: gzip.open(path, 'wb')),
+    "brotli": (".br", BrotliFile)
+}
+
+
+class ReportFile(object):
+    # writes a report file and its precompressed copies in one pass; all of them are
+    # written to temporary files and renamed on success, so a report is never left half-written
+    def __init__(self, path, compression=()):
+        if "brotli" in compression and brotli is None:
+            raise RuntimeError("brotli report compression requires brotli to be installed.")
+        self.paths = [path] + [path + REPORT_COMPRESSIONS[name][0] for name in compression]
+        self.files = [open(path + ".tmp", 'wb')]
+        self.files.extend(REPORT_COMPRESSIONS[name][1](path + REPORT_COMPRESSIONS[name][0] + ".tmp")
+                          for name in compression)
+        self.buffer = []
+        self.buffer_size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= REPORT_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        data = "".join(self.buffer)
+        for f in self.files:
+            f.write(data)
+        self.buffer = []
+        self.buffer_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        for f in self.files:
+            f.close()
+        for path in self.paths:
+            if exc_type is None:
+                os.rename(path + ".tmp", path)
+            else:
+                os.remove(path + ".tmp")
+
+
+def write_json_rows(f, rows):
+    f.write("[")
+    for i, row in enumerate(rows):
+        if i:
+            f.write(", ")
+        f.write(json.dumps(row))
+    f.write("]")
+
+
+def write_ndjson_rows(f, rows):
+    for row in rows:
+        f.write(json.dumps(row))
+        f.write("\n")
+
+
+def write_data_files(path, report_name, rows, compression=()):
+    names = []
+    for start in xrange(0, len(rows), REPORT_DATA_FILE_ROWS):
+        name = "{}-{}.ndjson".format(os.path.splitext(report_name)[0], len(names))
+        with ReportFile(os.path.join(path, name), compression) as f:
+            write_ndjson_rows(f, rows[start:start + REPORT_DATA_FILE_ROWS])
+        names.append(name)
+    return names
+
+
+def render_template(f, template_text, writers):
+    # same substitution as Template.safe_substitute, but every placeholder is written
+    # straight to f by its writer instead of being built as one string
+    position = 0
+    for match in Template.pattern.finditer(template_text):
+        name = match.group("named") or match.group("braced")
+        if name in writers:
+            f.write(template_text[position:match.start()])
+            writers[name](f)
+        elif match.group("escaped") is not None:
+            f.write(template_text[position:match.start()])
+            f.write(Template.delimiter)
+        else:
+            continue
+        position = match.end()
+    f.write(template_text[position:])
+
+
+def save_report(path, report_template, report_date, data, timeline_data=None, compression=(), data_file=False):
     with open(os.path.join(path, report_template), 'r') as f:
-        f_data = f.read()
+        template_text = f.read()
 
-    result = Template(f_data).safe_substitute(table_json=json.dumps(data))
-    with open(os.path.join(path, report_template.format(date=report_date)), 'w') as f:
-        f.write(result)
+    report_name = report_template.format(date=report_date)
+    writers = {"timeline_json": lambda f: f.write(json.dumps(timeline_data or []))}
+    if data_file:
+        # rows go to separate files that the report page loads one by one as it is scrolled
+        data_names = write_data_files(path, report_name, data, compression)
+        writers["table_json"] = lambda f: f.write("[]")
+        writers["data_files"] = lambda f: f.write(json.dumps(data_names))
+    else:
+        writers["table_json"] = lambda f: write_json_rows(f, data)
+        writers["data_files"] = lambda f: f.write("null")
+    with ReportFile(os.path.join(path, report_name), compression) as f:
+        render_template(f, template_text, writers)
 
 
 def get_report_date(log_file_name):
-    date_string = re.findall("(\d{8})", log_file_name)[0]
+    date_string = LOG_DATE_PATTERN.findall(log_file_name)[0]
     return datetime.strptime(date_string, "%Y%m%d").strftime("%Y.%m.%d")
 
 
@@ -176,51 +1829,461 @@ def setup_logging(path_to_save=None):
                         level=logging.INFO)
 
 
-def main(args):
+def get_cpu_seconds():
+    # workers are accounted in the children times once they are joined
+    times = os.times()
+    return sum(times[:4])
+
+
+def get_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+class RunMetrics(object):
+    # per stage wall and cpu time, lines, bytes and corrupted lines of one run;
+    # the metrics are saved after every stage and with the progress of a running stage
+    def __init__(self, path=None, metrics_format="json"):
+        self.path = path
+        self.format = metrics_format
+        self.started = time.time()
+        self.last_progress = self.started
+        self.stages = collections.OrderedDict()
+
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = collections.Counter()
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stage = self.get_stage(name)
+        wall, cpu = time.time(), get_cpu_seconds()
+        try:
+            yield stage
+        finally:
+            stage["wall_seconds"] += time.time() - wall
+            stage["cpu_seconds"] += get_cpu_seconds() - cpu
+            self.save()
+
+    def progress(self, name):
+        # a callback for the aggregation functions, called with the number of lines processed since the last call
+        stage, started = self.get_stage(name), time.time()
+
+        def report(n_lines):
+            stage["lines"] += n_lines
+            now = time.time()
+            if now - self.last_progress >= PROGRESS_INTERVAL:
+                self.last_progress = now
+                logging.info("{}: {} lines processed, {:.0f} lines/sec, peak rss {:.0f}MB".format(
+                    name, stage["lines"], stage["lines"] / (now - started), max(get_peak_rss_bytes()) / 2.0 ** 20))
+                self.save()
+
+        return report
+
+    def add_aggregates(self, name, urls, paths=()):
+        # lines are counted by the progress callback as they are parsed, these are the parsed files
+        stage = self.get_stage(name)
+        stage["errors"] += urls.n_errors
+        stage["bytes"] += sum(os.path.getsize(path) for path in paths)
+
+    def to_dict(self):
+        peak_rss, workers_peak_rss = get_peak_rss_bytes()
+        stages = collections.OrderedDict()
+        for name, stage in self.stages.iteritems():
+            stages[name] = dict(stage)
+            if stage["lines"] and stage["wall_seconds"]:
+                stages[name]["lines_per_second"] = stage["lines"] / stage["wall_seconds"]
+        return {
+            "started": self.started,
+            "updated": time.time(),
+            "peak_rss_bytes": peak_rss,
+            "workers_peak_rss_bytes": workers_peak_rss,
+            "stages": stages
+        }
+
+    def to_prometheus(self):
+        data = self.to_dict()
+        lines = []
+        for key in ("started", "updated"):
+            lines.append("# TYPE log_analyzer_{}_timestamp_seconds gauge".format(key))
+            lines.append("log_analyzer_{}_timestamp_seconds {}".format(key, data[key]))
+        for key in ("peak_rss_bytes", "workers_peak_rss_bytes"):
+            lines.append("# TYPE log_analyzer_{} gauge".format(key))
+            lines.append("log_analyzer_{} {}".format(key, data[key]))
+        for key in sorted(set(key for stage in data["stages"].itervalues() for key in stage)):
+            lines.append("# TYPE log_analyzer_stage_{} gauge".format(key))
+            for name, stage in data["stages"].iteritems():
+                lines.append('log_analyzer_stage_{}{{stage="{}"}} {}'.format(key, name, stage.get(key, 0)))
+        return "\n".join(lines) + "\n"
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            if self.format == "prometheus":
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+        os.rename(tmp_path, self.path)
+
+
+def get_metrics_path(ts_file, metrics_format):
+    if not metrics_format:
+        return None
+    return os.path.splitext(ts_file)[0] + METRICS_EXTENSIONS[metrics_format]
+
+
+class InotifyWatcher(object):
+    # inotify through libc, raises OSError where it is not available
+    def __init__(self, log_dirs, name_pattern):
+        self.name_pattern = name_pattern
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init"):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        for log_dir in log_dirs:
+            # paths from the json config are unicode, ctypes would pass them as wchar_t*
+            if isinstance(log_dir, unicode):
+                log_dir = log_dir.encode(sys.getfilesystemencoding())
+            if libc.inotify_add_watch(self.fd, log_dir, INOTIFY_EVENTS) < 0:
+                self.close()
+                raise OSError(ctypes.get_errno(), "{}: {}".format(log_dir, os.strerror(ctypes.get_errno())))
+
+    def wait(self, timeout):
+        # True once a file matching name_pattern is written or moved into one of the dirs
+        deadline = time.time() + timeout
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], max(deadline - time.time(), 0))
+            if not ready:
+                return False
+            data = os.read(self.fd, INOTIFY_BUFFER_SIZE)
+            names, offset = [], 0
+            while offset < len(data):
+                _, _, _, length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                names.append(data[offset:offset + length].rstrip("\0"))
+                offset += length
+            if fnmatch.filter(names, self.name_pattern):
+                return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    # a new or renamed file changes the mtime of its dir
+    def __init__(self, log_dirs):
+        self.log_dirs = log_dirs
+        self.mtimes = self.get_mtimes()
+
+    def get_mtimes(self):
+        mtimes = []
+        for log_dir in self.log_dirs:
+            try:
+                mtimes.append(os.stat(log_dir).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(min(WATCH_POLL_INTERVAL, max(deadline - time.time(), 0)))
+            mtimes = self.get_mtimes()
+            if mtimes != self.mtimes:
+                self.mtimes = mtimes
+                return True
+        return False
+
+    def close(self):
+        pass
+
+
+def get_watcher(log_dirs, name_pattern):
     try:
-        setup_logging(args.logging_file)
-        config_file = load_config(args.custom_config)
+        return InotifyWatcher(log_dirs, name_pattern)
+    except OSError as error:
+        logging.info("inotify is not available, polling log dirs every {}s: {}".format(WATCH_POLL_INTERVAL, error))
+        return PollingWatcher(log_dirs)
+
+
+def get_watched_dirs(args, config_file):
+    if args.log_dirs or config_file["LOG_DIRS"]:
+        return expand_log_dirs(args.log_dirs or config_file["LOG_DIRS"])
+    return [config_file["LOG_DIR"]]
+
+
+def stop_watching(signum, frame):
+    raise SystemExit(0)
+
+
+def watch(args, config_file, metrics):
+    # one long-running process with a warm worker pool: every run is started by a new rotated file
+    # or by WATCH_INTERVAL, which also picks up new host dirs and the live log of -f
+    watcher, log_dirs = None, None
+    logging.info("Watching for new log files, rescan every {}s".format(config_file["WATCH_INTERVAL"]))
+    try:
+        with worker_pool(args.jobs or config_file["WORKERS"]) as pool:
+            signal.signal(signal.SIGTERM, stop_watching)
+            while True:
+                if get_watched_dirs(args, config_file) != log_dirs:
+                    if watcher is not None:
+                        watcher.close()
+                    log_dirs = get_watched_dirs(args, config_file)
+                    watcher = get_watcher(log_dirs, config_file["LOG_NAME_PATTERN"])
+                try:
+                    run(args, config_file, metrics, pool)
+                except Exception as error:
+                    logging.exception(error)
+                if watcher.wait(config_file["WATCH_INTERVAL"]):
+                    while watcher.wait(WATCH_SETTLE):
+                        pass
+    except (KeyboardInterrupt, SystemExit):
+        logging.info("Watch mode is stopped.")
+    finally:
+        if watcher is not None:
+            watcher.close()
+
 
-        report_size = config_file["REPORT_SIZE"]
-        report_dir = config_file["REPORT_DIR"]
-        report_template = config_file["REPORT_TEMPLATE"]
-        log_dir = config_file["LOG_DIR"]
-        name_pattern = config_file["LOG_NAME_PATTERN"]
-        errors_limit = config_file["ERRORS_LIMIT"]
-        ts_file = config_file["TS_FILE"]
+def run(args, config_file, metrics, pool=None):
+    report_size = config_file["REPORT_SIZE"]
+    report_dir = config_file["REPORT_DIR"]
+    report_template = config_file["REPORT_TEMPLATE"]
+    log_dir = config_file["LOG_DIR"]
+    name_pattern = config_file["LOG_NAME_PATTERN"]
+    errors_limit = config_file["ERRORS_LIMIT"]
+    ts_file = config_file["TS_FILE"]
+    workers = args.jobs or config_file["WORKERS"]
+    quantile_mode = config_file["QUANTILE_MODE"]
+    parser = args.parser or config_file["PARSER"]
+    normalizer = get_url_normalizer(config_file)
+    gzip_backend = config_file["GZIP_BACKEND"]
+    engine = args.engine or config_file["ENGINE"]
+    timeline_resolution = config_file["TIMELINE_RESOLUTION"]
+    timeline = timeline_resolution is not None
+    report_compression = config_file["REPORT_COMPRESSION"]
+    report_data_file = config_file["REPORT_DATA_FILE"]
 
+    if args.follow:
+        live_log_name = config_file["LIVE_LOG_NAME"]
+        logging.info("Following live log file: {}".format(os.path.join(log_dir, live_log_name)))
         try:
-            latest_log_file_path = get_latest_log_file_path(log_dir, name_pattern)
-        except StandardError as error:
-            logging.info(error.message)
+            with metrics.stage("aggregate"):
+                current, finished = follow_log(log_dir, live_log_name, get_checkpoint_path(ts_file),
+                                               errors_limit, quantile_mode, parser, normalizer, timeline)
+            for checkpoint in filter(None, (finished, current)):
+                if checkpoint["urls"]:
+                    with metrics.stage("report"):
+                        report_data = build_report(checkpoint["urls"], report_size)
+                        timeline_data = build_timeline(checkpoint["urls"].timeline, timeline_resolution)
+                    with metrics.stage("save"):
+                        save_report(report_dir, report_template, checkpoint["date"], report_data,
+                                    timeline_data, report_compression, report_data_file)
+            update_ts_file(ts_file)
+            logging.info("All done!")
+        except RuntimeError as error:
+            logging.error("Script stopped abnormally by error: {}".format(error.message))
+        return
+
+    if args.date_from or args.date_to:
+        log_files = get_log_files_in_range(log_dir, name_pattern, args.date_from or "00000000",
+                                           args.date_to or "99999999")
+        if not log_files:
+            logging.info("There are no log files in the requested range.")
             return
 
-        if is_report_exists(report_dir, report_template, latest_log_file_path):
-            logging.info("Report for {} already exists.".format(latest_log_file_path))
+        logging.info("Building report for {} log files".format(len(log_files)))
+        try:
+            with metrics.stage("aggregate") as stage:
+                urls = aggregate_range(log_files, config_file["AGGREGATES_DIR"], errors_limit, workers,
+                                       quantile_mode, parser, normalizer, gzip_backend,
+                                       metrics.progress("aggregate"), pool, stage, timeline)
+            report_date = "{}-{}".format(get_report_date(log_files[0][0]), get_report_date(log_files[-1][0]))
+            with metrics.stage("report"):
+                report_data = build_report(urls, report_size)
+                timeline_data = build_timeline(urls.timeline, timeline_resolution)
+            with metrics.stage("save"):
+                save_report(report_dir, report_template, report_date, report_data, timeline_data,
+                            report_compression, report_data_file)
+            update_ts_file(ts_file)
+            logging.info("All done!")
+        except RuntimeError as error:
+            logging.error("Script stopped abnormally by error: {}".format(error.message))
+        return
+
+    if args.log_dirs or config_file["LOG_DIRS"]:
+        log_dirs = expand_log_dirs(args.log_dirs or config_file["LOG_DIRS"])
+        if not log_dirs:
+            logging.info("There are no log dirs matching {}.".format(args.log_dirs or config_file["LOG_DIRS"]))
             return
 
-        logging.info("Starting analysing log file: {}".format(latest_log_file_path))
+        index = LogIndex(get_index_path(ts_file))
+        with metrics.stage("scan"):
+            for log_dir, host in sorted(get_host_names(log_dirs).iteritems()):
+                index.scan(host, log_dir, name_pattern)
+            pending = []
+            for host, log_date, path in index.get_pending():
+                if os.path.isfile(os.path.join(report_dir, report_template.format(
+                        date=get_host_report_date(host, log_date)))):
+                    index.mark_processed(host, path)
+                else:
+                    pending.append((host, log_date, path))
+            index.save()
+        logging.info("Analysing {} log files of {} hosts".format(len(pending), len(log_dirs)))
+
+        aggregates_dir = config_file["AGGREGATES_DIR"]
+        log_dates = set()
         try:
-            parsed_log = parse_log(latest_log_file_path, errors_limit)
-            report_data = analyze_log(parsed_log, report_size)
-            save_report(report_dir, report_template,
-                        get_report_date(latest_log_file_path), report_data)
+            results = aggregate_hosts(pending, aggregates_dir, errors_limit, workers, quantile_mode, parser,
+                                      normalizer, gzip_backend, metrics.progress("aggregate"), pool,
+                                      metrics.get_stage("aggregate"), timeline)
+            while True:
+                with metrics.stage("aggregate"):
+                    result = next(results, None)
+                if result is None:
+                    break
+                host, log_date, path, urls, error = result
+                if error is not None:
+                    logging.error("Log file {} is skipped by error: {}".format(path, error))
+                    index.mark_failed(host, path)
+                    index.save()
+                    continue
+                with metrics.stage("report"):
+                    report_data = build_report(urls, report_size)
+                    timeline_data = build_timeline(urls.timeline, timeline_resolution)
+                with metrics.stage("save"):
+                    save_report(report_dir, report_template, get_host_report_date(host, log_date), report_data,
+                                timeline_data, report_compression, report_data_file)
+                index.mark_processed(host, path)
+                index.save()
+                log_dates.add(log_date)
 
+            # the combined report of a day merges the cached aggregates of every host that has the day
+            for log_date in sorted(log_dates):
+                with metrics.stage("report"):
+                    urls = LogAggregates(get_cached_quantile_mode(quantile_mode))
+                    for host, path in index.get_processed(log_date):
+                        merge_aggregates(urls, get_day_aggregates(path, log_date,
+                                                                  os.path.join(aggregates_dir, host),
+                                                                  errors_limit, 1, quantile_mode, parser,
+                                                                  normalizer, gzip_backend, timeline=timeline))
+                    report_data = build_report(urls, report_size)
+                    timeline_data = build_timeline(urls.timeline, timeline_resolution)
+                with metrics.stage("save"):
+                    save_report(report_dir, report_template, get_report_date(log_date), report_data,
+                                timeline_data, report_compression, report_data_file)
             update_ts_file(ts_file)
-
             logging.info("All done!")
         except RuntimeError as error:
             logging.error("Script stopped abnormally by error: {}".format(error.message))
+        return
+
+    try:
+        latest_log_file_path = get_latest_log_file_path(log_dir, name_pattern)
+    except StandardError as error:
+        logging.info(error.message)
+        return
+
+    if is_report_exists(report_dir, report_template, latest_log_file_path):
+        logging.info("Report for {} already exists.".format(latest_log_file_path))
+        return
+
+    logging.info("Starting analysing log file: {}".format(latest_log_file_path))
+    try:
+        if engine == "numpy" and numpy is None:
+            raise RuntimeError("numpy engine requires numpy to be installed.")
+        if args.export:
+            columns_path = os.path.join(config_file["EXPORT_DIR"], LOG_DATE_PATTERN.findall(latest_log_file_path)[0])
+            if not os.path.isfile(os.path.join(columns_path, "meta.json")):
+                with metrics.stage("export") as stage:
+                    export_log(latest_log_file_path, columns_path, errors_limit, gzip_backend)
+                    stage["bytes"] += os.path.getsize(latest_log_file_path)
+            with metrics.stage("aggregate") as stage:
+                aggregate = numpy_aggregate_columns if engine == "numpy" else aggregate_columns
+                urls = aggregate(columns_path, quantile_mode, normalizer, timeline)
+                stage["lines"] += load_columns_meta(columns_path)["size"]
+        else:
+            with metrics.stage("aggregate"):
+                urls = aggregate_file(latest_log_file_path, errors_limit, workers, quantile_mode, parser,
+                                      normalizer, gzip_backend, metrics.progress("aggregate"), pool, timeline,
+                                      engine)
+                metrics.add_aggregates("aggregate", urls, [latest_log_file_path])
+        with metrics.stage("report"):
+            report_data = build_report(urls, report_size)
+            timeline_data = build_timeline(urls.timeline, timeline_resolution)
+        with metrics.stage("save"):
+            save_report(report_dir, report_template, get_report_date(latest_log_file_path), report_data,
+                        timeline_data, report_compression, report_data_file)
+
+        update_ts_file(ts_file)
+
+        logging.info("All done!")
+    except RuntimeError as error:
+        logging.error("Script stopped abnormally by error: {}".format(error.message))
+
+
+def main(args):
+    try:
+        setup_logging(args.logging_file)
+        config_file = load_config(args.custom_config)
+        metrics_format = config_file["METRICS_FORMAT"]
+        metrics = RunMetrics(get_metrics_path(config_file["TS_FILE"], metrics_format), metrics_format)
+        if args.watch:
+            watch(args, config_file, metrics)
+        else:
+            run(args, config_file, metrics)
     except BaseException as base_e:
         logging.exception(base_e)
 
 
+def parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y%m%d").strftime("%Y%m%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("Date must be in YYYYMMDD format: {}".format(value))
+
+
 def parse_sys_args():
     parser = argparse.ArgumentParser(description="Nginx log file analyzer")
     parser.add_argument("-c", "--config", dest="custom_config", help="custom config file")
     parser.add_argument("-l", "--log", dest="logging_file", help="path to save logging file")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, help="number of worker processes")
+    parser.add_argument("--parser", dest="parser", choices=sorted(PARSERS), help="log line parser")
+    parser.add_argument("-f", "--follow", dest="follow", action="store_true",
+                        help="incrementally analyse the live log file")
+    parser.add_argument("--from", dest="date_from", type=parse_date, help="first day of the report, YYYYMMDD")
+    parser.add_argument("--to", dest="date_to", type=parse_date, help="last day of the report, YYYYMMDD")
+    parser.add_argument("-e", "--export", dest="export", action="store_true",
+                        help="export parsed fields to EXPORT_DIR in columnar format and analyse from there")
+    parser.add_argument("--engine", dest="engine", choices=ENGINES, help="aggregation engine")
+    parser.add_argument("-d", "--dir", dest="log_dirs", action="append",
+                        help="log dir or glob of host log dirs, repeatable; overrides LOG_DIRS")
+    parser.add_argument("-w", "--watch", dest="watch", action="store_true",
+                        help="keep running and analyse every new rotated log file as soon as it appears")
+    parser.add_argument("--profile", dest="profile", help="save cProfile stats of the run to this file")
     return parser.parse_args()
 
 
+def run_profiled(func, args, path):
+    # only the main process is profiled, worker processes of -j are not
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(func, args)
+    finally:
+        profiler.dump_stats(path)
+        stream = StringIO.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        logging.info("Profile is saved to {}\n{}".format(path, stream.getvalue()))
+
+
 if __name__ == "__main__":
-    main(parse_sys_args())
+    sys_args = parse_sys_args()
+    if sys_args.profile:
+        run_profiled(main, sys_args, sys_args.profile)
+    else:
+        main(sys_args)
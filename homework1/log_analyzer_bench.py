@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import log_analyzer
+from distutils.spawn import find_executable
+
+LINE_TEMPLATE = ('{ip} {user}  - [{time_local}] "GET {url} HTTP/1.1" {status} {size} "-" "{user_agent}" "-" '
+                 '"{request_id}" "-" {request_time:.3f}\n')
+SUITES = ("parsers", "gzip", "stages")
+STAGES = ("xreadlines", "parse_log", "apply_filters", "analyze_log", "save_report")
+# readers of a plain log in the parsers suite: file iteration, seek + readline and mmap over the worker ranges
+READERS = ("file", "readline", "mmap")
+USER_AGENTS = ("Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5", "Python-urllib/2.7", "Slotovod",
+               "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110")
+CORRUPTED_LINES = ('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n',
+                   '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 HTTP/1.1" 200 9 "-" "Lynx\n',
+                   '\x00\x00\x00\x00\n')
+LOG_START = 1498683600  # 29/Jun/2017:00:00:00 +0300
+LOG_DURATION = 24 * 3600
+
+
+def generate_log(path, n_lines, n_urls=10000, seed=42, corruption_rate=0.0):
+    # the same arguments always produce the same file; lines are spread evenly over one day
+    rnd = random.Random(seed)
+    urls = ["/api/v2/banner/{}".format(rnd.randint(1, 10 ** 8)) for _ in xrange(n_urls)]
+    open_log = gzip.open if path.endswith(".gz") else open
+    second, time_local = None, None
+    with open_log(path, 'wb') as f:
+        for i in xrange(n_lines):
+            if corruption_rate and rnd.random() < corruption_rate:
+                f.write(rnd.choice(CORRUPTED_LINES))
+                continue
+            timestamp = LOG_START + i * LOG_DURATION // n_lines
+            if timestamp != second:
+                second = timestamp
+                time_local = time.strftime("%d/%b/%Y:%H:%M:%S +0300", time.gmtime(timestamp + 3 * 3600))
+            f.write(LINE_TEMPLATE.format(
+                ip="1.{}.{}.{}".format(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)),
+                user=rnd.choice(("-", "3b81f63526fa8")),
+                time_local=time_local,
+                url=urls[int(rnd.paretovariate(1.2)) % n_urls],
+                status=200 if rnd.random() < 0.98 else 404,
+                size=rnd.randint(0, 20000),
+                user_agent=rnd.choice(USER_AGENTS),
+                request_id="{}-{}-4708-{}".format(timestamp, rnd.randint(0, 2 ** 32), i),
+                request_time=rnd.expovariate(5)
+            ))
+
+
+def compress_log(path, gz_path):
+    with open(path, 'rb') as src, gzip.open(gz_path, 'wb') as dst:
+        for block in iter(lambda: src.read(log_analyzer.READ_BLOCK_SIZE), ''):
+            dst.write(block)
+
+
+def run_isolated(func, *args):
+    # every benchmark runs in a forked child, so ru_maxrss of the child is the peak RSS of that benchmark only;
+    # func returns the number of processed items or (items, seconds) when it has to exclude its own setup
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            start = time.time()
+            items = func(*args)
+            elapsed = time.time() - start
+            result = {"items": items[0], "seconds": items[1]} if isinstance(items, tuple) else \
+                {"items": items, "seconds": elapsed}
+        except BaseException as e:
+            result = {"error": repr(e)}
+        with os.fdopen(write_fd, 'w') as f:
+            json.dump(result, f)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'r') as f:
+        data = f.read()
+    _, status, rusage = os.wait4(pid, 0)
+    result = json.loads(data) if data else {"error": "benchmark exited with status {}".format(status)}
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    result["peak_rss_kb"] = rusage.ru_maxrss // 1024 if sys.platform == "darwin" else rusage.ru_maxrss
+    result["rate"] = result["items"] / result["seconds"] if result["seconds"] else 0.0
+    return result
+
+
+def bench_gzip_backend(gz_path, backend):
+    return sum(len(block) for block in log_analyzer.GZIP_BACKENDS[backend](gz_path))
+
+
+def bench_parser(path, n_lines, parser):
+    return sum(1 for _ in log_analyzer.parse_log(path, n_lines + 1, parser))
+
+
+def bench_reader(path, n_lines, reader):
+    # fast parser fed by a plain file reader, the ranges are those of four workers
+    if reader == "file":
+        lines = open(path, 'rb')
+    elif reader == "readline":
+        lines = (line for start, end in log_analyzer.get_chunks(path, 4) for line in readline_range(path, start, end))
+    else:
+        lines = (line for start, end in log_analyzer.get_chunks(path, 4)
+                 for line in log_analyzer.xreadlines_range(path, start, end))
+    return sum(1 for _ in log_analyzer.parse_lines(lines, n_lines + 1, "fast"))
+
+
+def readline_range(path, start, end):
+    with open(path, 'rb') as log_file:
+        log_file.seek(start)
+        position = start
+        for line in iter(log_file.readline, ''):
+            yield line
+            position += len(line)
+            if position >= end:
+                break
+
+
+def bench_xreadlines(path):
+    return sum(1 for _ in log_analyzer.xreadlines(path))
+
+
+def bench_apply_filters(path, n_lines):
+    # includes the regex match, apply_filters consumes the groupdicts of LOG_LINE_PATTERN
+    matches = (log_analyzer.LOG_LINE_PATTERN.match(line) for line in log_analyzer.xreadlines(path))
+    parsed_line_dict = (match.groupdict() if match else {} for match in matches)
+    filters = {
+        "request": lambda req: req.split(" ")[1],
+        "request_time": float
+    }
+    return sum(1 for _ in log_analyzer.apply_filters(parsed_line_dict, n_lines + 1, filters))
+
+
+def bench_analyze_log(path, n_lines):
+    log_analyzer.analyze_log(log_analyzer.parse_log(path, n_lines + 1), log_analyzer.config["REPORT_SIZE"])
+    return n_lines
+
+
+def bench_save_report(path, n_lines, report_dir):
+    # every url goes to the report, as with REPORT_SIZE raised for drill-down; only rendering is timed
+    urls = log_analyzer.aggregate_log(log_analyzer.parse_log(path, n_lines + 1), timeline=True)
+    report_data = log_analyzer.build_report(urls, len(urls))
+    timeline_data = log_analyzer.build_timeline(urls.timeline)
+    start = time.time()
+    log_analyzer.save_report(report_dir, "report-{date}.html", "2017.06.29", report_data, timeline_data)
+    return len(report_data), time.time() - start
+
+
+def run_stages(path, n_lines, work_dir):
+    report_dir = os.path.join(work_dir, "reports")
+    os.mkdir(report_dir)
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "reports", "report-{date}.html"),
+                report_dir)
+    benchmarks = {
+        "xreadlines": (bench_xreadlines, path),
+        "parse_log": (bench_parser, path, n_lines, "fast"),
+        "apply_filters": (bench_apply_filters, path, n_lines),
+        "analyze_log": (bench_analyze_log, path, n_lines),
+        "save_report": (bench_save_report, path, n_lines, report_dir)
+    }
+    for stage in STAGES:
+        yield "stage.{}".format(stage), run_isolated(*benchmarks[stage])
+
+
+def run_parsers(path, n_lines):
+    for parser in sorted(log_analyzer.PARSERS):
+        yield "parser.{}".format(parser), run_isolated(bench_parser, path, n_lines, parser)
+    for reader in READERS:
+        yield "parser.fast.{}".format(reader), run_isolated(bench_reader, path, n_lines, reader)
+
+
+def run_gzip_backends(gz_path):
+    for backend in sorted(log_analyzer.GZIP_BACKENDS):
+        if backend in log_analyzer.GZIP_COMMANDS and not find_executable(log_analyzer.GZIP_COMMANDS[backend]):
+            continue
+        yield "gzip.{}".format(backend), run_isolated(bench_gzip_backend, gz_path, backend)
+
+
+def get_params(args):
+    return {"lines": args.lines, "urls": args.urls, "corruption": args.corruption, "seed": args.seed,
+            "gzip": args.gzip}
+
+
+def compare_params(params, baseline_params):
+    # rates of runs on different logs are not comparable, a gzipped log alone makes every stage slower
+    return ["{}={} (baseline {})".format(name, value, baseline_params.get(name))
+            for name, value in sorted(params.iteritems()) if baseline_params.get(name) != value]
+
+
+def compare_results(results, baseline, tolerance):
+    # a benchmark regresses when its rate drops more than tolerance below the baseline
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        change = result["rate"] / baseline[name]["rate"] - 1 if baseline[name]["rate"] else 0.0
+        print("{:<24} baseline={:.0f}/s current={:.0f}/s change={:+.1%}".format(
+              name, baseline[name]["rate"], result["rate"], change))
+        if change < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def parse_sys_args():
+    parser = argparse.ArgumentParser(description="log_analyzer benchmarks")
+    parser.add_argument("-n", "--lines", dest="lines", type=int, default=2000000)
+    parser.add_argument("-u", "--urls", dest="urls", type=int, default=10000, help="url cardinality")
+    parser.add_argument("--corruption", dest="corruption", type=float, default=0.0,
+                        help="share of corrupted lines in the generated log")
+    parser.add_argument("--seed", dest="seed", type=int, default=42)
+    parser.add_argument("-z", "--gzip", dest="gzip", action="store_true",
+                        help="run the stages on a gzipped log")
+    parser.add_argument("-s", "--suite", dest="suites", action="append", choices=SUITES,
+                        help="benchmark suite to run, all by default")
+    parser.add_argument("-o", "--output", dest="output", help="save results as json")
+    parser.add_argument("-b", "--baseline", dest="baseline", help="compare results with a saved json")
+    parser.add_argument("-t", "--tolerance", dest="tolerance", type=float, default=0.1,
+                        help="allowed slowdown against the baseline, 0.1 by default")
+    return parser.parse_args()
+
+
+def main(args):
+    # corrupted lines are logged by the analyzer, the messages are formatted but not kept
+    logging.basicConfig(filename=os.devnull, level=logging.INFO)
+    work_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(work_dir, "nginx-access-ui.log-20170629")
+        generate_log(path, args.lines, args.urls, args.seed, args.corruption)
+        suites = args.suites or SUITES
+        if args.gzip or "gzip" in suites:
+            compress_log(path, path + ".gz")
+
+        results = {}
+        benchmarks = []
+        if "parsers" in suites:
+            benchmarks.append(run_parsers(path, args.lines))
+        if "gzip" in suites:
+            benchmarks.append(run_gzip_backends(path + ".gz"))
+        if "stages" in suites:
+            benchmarks.append(run_stages(path + ".gz" if args.gzip else path, args.lines, work_dir))
+        for benchmark in benchmarks:
+            for name, result in benchmark:
+                results[name] = result
+                print("{:<24} items={} time={:.2f}s rate={:.0f}/s peak_rss={:.0f}MB".format(
+                      name, result["items"], result["seconds"], result["rate"], result["peak_rss_kb"] / 1024.0))
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({
+                    "params": get_params(args),
+                    "python": platform.python_version(),
+                    "results": results
+                }, f, indent=2, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)
+            differences = compare_params(get_params(args), baseline.get("params", {}))
+            if differences:
+                print("Baseline was run with other params, not compared: {}".format(", ".join(differences)))
+                return 2
+            regressions = compare_results(results, baseline["results"], args.tolerance)
+            if regressions:
+                print("Regressions: {}".format(", ".join(regressions)))
+                return 1
+        return 0
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_sys_args()))
@@ -1,6 +1,16 @@
 import unittest
+import collections
+import gzip
+import itertools
+import json
+import logging
 import os
+import random
+import shutil
+import tempfile
 import log_analyzer
+import log_analyzer_bench
+from string import Template
 
 
 class LogAnalyzerTest(unittest.TestCase):
@@ -23,6 +33,631 @@ class LogAnalyzerTest(unittest.TestCase):
                                                        log_analyzer.config["LOG_NAME_PATTERN"])
         self.assertEqual(expected, actual)
 
+    def test_chunks_are_aligned_to_lines(self):
+        path = "./log/nginx-access-ui.log-20170530"
+        chunks = log_analyzer.get_chunks(path, 4)
+        self.assertEqual(0, chunks[0][0])
+        self.assertEqual(os.path.getsize(path), chunks[-1][1])
+        lines = [line for start, end in chunks for line in log_analyzer.xreadlines_range(path, start, end)]
+        self.assertEqual(list(log_analyzer.xreadlines(path)), lines)
+
+    def test_mmap_reader_equals_file_lines(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(work_dir, "nginx-access-ui.log-20170629")
+            for content in ("", "a\n", "a\nbb\n\nccc", "a\n" * 1000):
+                with open(path, "w") as f:
+                    f.write(content)
+                self.assertEqual(open(path).readlines(), list(log_analyzer.xreadlines(path)))
+                self.assertEqual(open(path).readlines(), list(log_analyzer.xreadlines_range(path, 0, 10 ** 6)))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_parallel_analysis_equals_sequential(self):
+        path = "./log/nginx-access-ui.log-20170530"
+        expected = log_analyzer.analyze_log(log_analyzer.parse_log(path, 100), 1000)
+        actual = log_analyzer.build_report(log_analyzer.aggregate_log_parallel(path, 100, 3), 1000)
+        self.assertEqual(expected, actual)
+        # request times are grouped by url in batches, small batches give the same aggregates
+        for timeline in (False, True):
+            urls = log_analyzer.aggregate_log(log_analyzer.parse_log(path, 100), timeline=timeline, batch_size=7)
+            self.assertEqual(expected, log_analyzer.build_report(urls, 1000))
+
+    def test_exact_quantiles_median(self):
+        times = [0.5, 0.1, 0.3, 0.2]
+        quantiles = log_analyzer.ExactQuantiles()
+        for t in times:
+            quantiles.add(t)
+        self.assertEqual(log_analyzer.median(sorted(times)), quantiles.median())
+
+    def test_approx_quantiles_median_error_is_bounded(self):
+        left, right = log_analyzer.KLLQuantiles(), log_analyzer.KLLQuantiles()
+        values = [random.random() for _ in xrange(20000)]
+        for v in values[:10000]:
+            left.add(v)
+        for v in values[10000:]:
+            right.add(v)
+        left.merge(right)
+        self.assertLess(left.size, 1000)
+        self.assertAlmostEqual(log_analyzer.median(sorted(values)), left.median(), delta=0.05)
+
+    def test_histogram_percentiles_error_is_bounded(self):
+        left, right = log_analyzer.LatencyHistogram(), log_analyzer.LatencyHistogram()
+        values = [random.expovariate(5) for _ in xrange(20000)]
+        for v in values[:10000]:
+            left.add(v)
+        for v in values[10000:]:
+            right.add(v)
+        left.merge(log_analyzer.LatencyHistogram.from_dict(right.to_dict()))
+        exact = log_analyzer.ExactQuantiles()
+        for v in values:
+            exact.add(v)
+        self.assertEqual(len(values), left.size)
+        for p in (50, 90, 95, 99):
+            self.assertAlmostEqual(exact.percentile(p), left.percentile(p), delta=0.05 * exact.percentile(p))
+        self.assertLessEqual(left.percentile(100), max(values))
+
+    def test_report_percentiles_and_timeline(self):
+        path = "./log/nginx-access-ui.log-20170530"
+        self.assertEqual({}, log_analyzer.aggregate_log(log_analyzer.parse_log(path, 100)).timeline)
+        self.assertEqual([], log_analyzer.build_timeline({}, None))
+        urls = log_analyzer.aggregate_log(log_analyzer.parse_log(path, 100), timeline=True)
+        report = log_analyzer.build_report(urls, 1000)
+        self.assertTrue(all(r["time_med"] <= r["time_p90"] <= r["time_p95"] <= r["time_p99"] <= r["time_max"]
+                            for r in report))
+        timeline = log_analyzer.build_timeline(urls.timeline, "minute")
+        self.assertEqual(sum(urls.counts), sum(r["count"] for r in timeline))
+        self.assertEqual(sorted(r["time"] for r in timeline), [r["time"] for r in timeline])
+        hourly = log_analyzer.build_timeline(urls.timeline, "hour")
+        self.assertEqual(sum(urls.counts), sum(r["count"] for r in hourly))
+        restored = log_analyzer.load_aggregates(log_analyzer.dump_aggregates(urls))
+        self.assertEqual(timeline, log_analyzer.build_timeline(restored.timeline, "minute"))
+
+    def test_approx_report_keeps_counts(self):
+        path = "./log/nginx-access-ui.log-20170530"
+        expected = log_analyzer.analyze_log(log_analyzer.parse_log(path, 100), 1000)
+        actual = log_analyzer.analyze_log(log_analyzer.parse_log(path, 100), 1000, "approx")
+        self.assertEqual([(r["url"], r["count"], r["time_sum"]) for r in expected],
+                         [(r["url"], r["count"], r["time_sum"]) for r in actual])
+
+    def test_fast_parser_equals_regex_parser(self):
+        path = "./log/nginx-access-ui.log-20170530"
+        self.assertEqual(list(log_analyzer.parse_log(path, 100, "regex")),
+                         list(log_analyzer.parse_log(path, 100, "fast")))
+
+    def test_fast_parser_counts_corrupted_lines(self):
+        lines = ['1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n',
+                 '1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/1 HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.133\n',
+                 'garbage\n']
+        self.assertEqual([("/api/1", 0.133, "29/Jun/2017:03:50:22 +0300")], list(log_analyzer.parse_lines(lines, 3)))
+        with self.assertRaises(RuntimeError):
+            list(log_analyzer.parse_lines(lines, 2))
+        # request_time is validated as by the regex parser: float() alone would take nan, inf, signs and exponents
+        line = '1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/1 HTTP/1.1" 200 1 "-" "-" "-" "-" "-" {}\n'
+        lines = [line.format(request_time) for request_time in ("nan", "inf", "-1.0", "1e3", "1.", ".5", "0.133 ")]
+        for parser in ("fast", "regex"):
+            self.assertEqual([("/api/1", 0.133, "29/Jun/2017:03:50:22 +0300")],
+                             list(log_analyzer.parse_lines(lines, len(lines), parser)))
+
+    def test_errors_limit_share_is_checked_early(self):
+        good = '1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/1 HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.133\n'
+        lines = ([good] * 99 + ["garbage\n"]) * 30
+        for parser in ("fast", "regex"):
+            self.assertEqual(2970, len(list(log_analyzer.parse_lines(lines, 0.02, parser))))
+            with self.assertRaises(RuntimeError):
+                list(log_analyzer.parse_lines(lines, 0.005, parser))
+            # an endless garbage stream stops after ERRORS_MIN_LINES lines instead of being read to the end
+            with self.assertRaises(RuntimeError):
+                list(log_analyzer.parse_lines(itertools.repeat("garbage\n"), 0.01, parser))
+
+    def test_only_first_corrupted_lines_are_logged(self):
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logging.getLogger().addHandler(handler)
+        try:
+            self.assertEqual([], list(log_analyzer.parse_lines(["garbage\n"] * 100, 101)))
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEqual(log_analyzer.ERRORS_LOGGED + 1, len(messages))
+        self.assertIn("{} more".format(100 - log_analyzer.ERRORS_LOGGED), messages[-1])
+
+    def test_parallel_errors_limit_and_logging_cover_whole_run(self):
+        good = '1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/1 HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.133\n'
+        work_dir = tempfile.mkdtemp()
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logging.getLogger().addHandler(handler)
+        lines_per_task = log_analyzer.LINES_PER_TASK
+        try:
+            log_analyzer.LINES_PER_TASK = 1000
+            path = os.path.join(work_dir, "nginx-access-ui.log-20170629")
+            with open(path, "w") as f:
+                f.writelines(([good] * 90 + ["garbage\n"] * 10) * 40)
+            for log_path in (path, path + ".gz"):
+                if log_path.endswith(".gz"):
+                    with open(path, "rb") as src, gzip.open(log_path, "wb") as dst:
+                        dst.write(src.read())
+                # every one of 4 chunks or batches has 100 corrupted lines, all of them are 400
+                with self.assertRaises(RuntimeError):
+                    log_analyzer.aggregate_log_parallel(log_path, 300, 4)
+                del messages[:]
+                urls = log_analyzer.aggregate_log_parallel(log_path, 401, 4)
+                self.assertEqual(400, urls.n_errors)
+                self.assertEqual(log_analyzer.ERRORS_LOGGED + 1, len(messages))
+                self.assertIn("{} more".format(400 - log_analyzer.ERRORS_LOGGED), messages[-1])
+        finally:
+            log_analyzer.LINES_PER_TASK = lines_per_task
+            logging.getLogger().removeHandler(handler)
+            shutil.rmtree(work_dir)
+
+    def test_compiled_filters_convert_every_field(self):
+        filters = {"request": lambda req: req.split(" ")[1], "request_time": float, "time_local": str}
+        lines = [{"request": "GET /api/1 HTTP/1.1", "request_time": "0.133", "time_local": "t"},
+                 {"request": "GET /api/2 HTTP/1.1", "request_time": "-"},
+                 {"request": "0", "request_time": "1.0", "time_local": "t"}]
+        expected = {key: convert(lines[0][key]) for key, convert in filters.items()}
+        stats = collections.Counter()
+        self.assertEqual([expected], list(log_analyzer.apply_filters(lines, 3, filters, stats)))
+        self.assertEqual(2, stats["errors"])
+
+        def interrupt(value):
+            raise KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            list(log_analyzer.apply_filters(lines, 3, {"request": interrupt}))
+
+    def test_follow_log_resumes_from_checkpoint_and_survives_rotation(self):
+        with open("./log/nginx-access-ui.log-20170530") as f:
+            lines = f.readlines()
+        expected = log_analyzer.analyze_log(log_analyzer.parse_lines(lines, 100), 1000)
+        work_dir = tempfile.mkdtemp()
+        try:
+            live_path = os.path.join(work_dir, "nginx-access-ui.log")
+            checkpoint_path = os.path.join(work_dir, "log_analyzer.checkpoint")
+            with open(live_path, "w") as f:
+                f.writelines(lines[:10])
+                f.write(lines[10][:20])
+            current, finished = log_analyzer.follow_log(work_dir, "nginx-access-ui.log", checkpoint_path, 100)
+            self.assertIsNone(finished)
+            self.assertEqual(sum(len(line) for line in lines[:10]), current["offset"])
+
+            with open(live_path, "a") as f:
+                f.write(lines[10][20:])
+                f.writelines(lines[11:20])
+            os.rename(live_path, os.path.join(work_dir, "nginx-access-ui.log-20170530"))
+            with open(live_path, "w") as f:
+                f.writelines(lines[20:])
+            current, finished = log_analyzer.follow_log(work_dir, "nginx-access-ui.log", checkpoint_path, 100)
+
+            merged = log_analyzer.merge_aggregates(finished["urls"], current["urls"])
+            self.assertEqual(expected, log_analyzer.build_report(merged, 1000))
+
+            # a checkpoint saved with other settings is dropped and the live log is read from the start
+            normalizer = log_analyzer.UrlNormalizer(numeric_ids=True)
+            current, finished = log_analyzer.follow_log(work_dir, "nginx-access-ui.log", checkpoint_path, 100,
+                                                        normalizer=normalizer)
+            self.assertIsNone(finished)
+            self.assertEqual(log_analyzer.analyze_log(log_analyzer.parse_lines(lines[20:], 100), 1000,
+                                                      normalizer=normalizer),
+                             log_analyzer.build_report(current["urls"], 1000))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_range_report_is_built_from_cached_day_aggregates(self):
+        with open("./log/nginx-access-ui.log-20170530") as f:
+            lines = f.readlines()
+        # exact quantiles are cached as histograms
+        expected = log_analyzer.analyze_log(log_analyzer.parse_lines(lines + lines[:10], 100), 1000, "histogram")
+        work_dir = tempfile.mkdtemp()
+        try:
+            log_dir, aggregates_dir = os.path.join(work_dir, "log"), os.path.join(work_dir, "aggregates")
+            new_log_dir = os.path.join(work_dir, "new-log")
+            os.mkdir(log_dir)
+            os.mkdir(new_log_dir)
+            with open(os.path.join(log_dir, "nginx-access-ui.log-20170529"), "w") as f:
+                f.writelines(lines)
+            with gzip.open(os.path.join(log_dir, "nginx-access-ui.log-20170530.gz"), "wb") as f:
+                f.writelines(lines[:10])
+            with open(os.path.join(log_dir, "nginx-access-ui.log-20170601"), "w") as f:
+                f.writelines(lines)
+            # delaycompress: the day is kept in both files, it is counted once
+            with gzip.open(os.path.join(log_dir, "nginx-access-ui.log-20170529.gz"), "wb") as f:
+                f.writelines(lines)
+            log_files = log_analyzer.get_log_files_in_range(log_dir, "nginx-access-ui.log-*", "20170501", "20170531")
+            self.assertEqual([("20170529", os.path.join(log_dir, "nginx-access-ui.log-20170529")),
+                              ("20170530", os.path.join(log_dir, "nginx-access-ui.log-20170530.gz"))], log_files)
+
+            stats, progress = collections.Counter(), []
+            urls = log_analyzer.aggregate_range(log_files, aggregates_dir, 100, progress=progress.append, stats=stats)
+            self.assertEqual(expected, log_analyzer.build_report(urls, 1000))
+            self.assertEqual(len(lines) + 10, sum(progress))
+            self.assertEqual(sum(os.path.getsize(path) for _, path in log_files), stats["bytes"])
+            self.assertEqual(2, stats["files"])
+
+            # cached days are not parsed, so they are not counted
+            shutil.rmtree(log_dir)
+            cached_stats, progress = collections.Counter(), []
+            urls = log_analyzer.aggregate_range(log_files, aggregates_dir, 100, progress=progress.append,
+                                                stats=cached_stats)
+            self.assertEqual(expected, log_analyzer.build_report(urls, 1000))
+            self.assertEqual([], progress)
+            self.assertFalse(cached_stats)
+
+            # days cached with other settings are built again
+            with open(os.path.join(new_log_dir, "nginx-access-ui.log-20170529"), "w") as f:
+                f.writelines(lines)
+            log_files = [("20170529", os.path.join(new_log_dir, "nginx-access-ui.log-20170529"))]
+            normalizer = log_analyzer.UrlNormalizer(numeric_ids=True)
+            for quantile_mode, normalizer in (("approx", None), ("approx", normalizer), ("exact", None)):
+                stats = collections.Counter()
+                urls = log_analyzer.aggregate_range(log_files, aggregates_dir, 100, quantile_mode=quantile_mode,
+                                                    normalizer=normalizer, stats=stats)
+                self.assertEqual(1, stats["files"])
+                self.assertEqual(log_analyzer.build_report(log_analyzer.aggregate_log(
+                    log_analyzer.parse_lines(lines, 100), log_analyzer.get_cached_quantile_mode(quantile_mode),
+                    normalizer), 5), log_analyzer.build_report(urls, 5))
+            stats = collections.Counter()
+            urls = log_analyzer.aggregate_range(log_files, aggregates_dir, 100, stats=stats, timeline=True)
+            self.assertEqual(1, stats["files"])
+            self.assertEqual(len(lines), sum(r["count"] for r in log_analyzer.build_timeline(urls.timeline)))
+
+            # a corrupted cache file is built again too
+            with open(os.path.join(aggregates_dir, "aggregate-20170529.json.gz"), "wb") as f:
+                f.write("garbage")
+            stats = collections.Counter()
+            log_analyzer.aggregate_range(log_files, aggregates_dir, 100, stats=stats)
+            self.assertEqual(1, stats["files"])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_report_keeps_top_urls_by_time_sum(self):
+        urls = log_analyzer.aggregate_log(log_analyzer.parse_log("./log/nginx-access-ui.log-20170530", 100))
+        full_report = log_analyzer.build_report(urls, len(urls))
+        self.assertEqual(sorted(full_report, key=lambda row: row["time_sum"], reverse=True)[:5],
+                         log_analyzer.build_report(urls, 5))
+
+    def test_url_normalizer(self):
+        normalizer = log_analyzer.UrlNormalizer(
+            drop_query=True, numeric_ids=True,
+            templates=[(r"^/api/1/photogenic_banners/[^/]+/", r"/api/1/photogenic_banners/{name}/")])
+        self.assertEqual("/api/v2/banner/{id}", normalizer("/api/v2/banner/25019354"))
+        self.assertEqual("/api/v2/banner/{id}/stat", normalizer("/api/v2/banner/1/stat?day=1"))
+        self.assertEqual("/api/1/photogenic_banners/{name}/", normalizer("/api/1/photogenic_banners/list/?s=W"))
+        self.assertEqual("/export/v2.1", normalizer("/export/v2.1"))
+
+    def test_url_templates_match_inside_path_segment(self):
+        normalizer = log_analyzer.UrlNormalizer(templates=[(r"^/api", r"/legacy"), (r"^/export$", r"/export/all")])
+        self.assertEqual("/legacyv2/banner/1", normalizer("/apiv2/banner/1"))
+        self.assertEqual("/legacy/v2/banner/1", normalizer("/api/v2/banner/1"))
+        self.assertEqual("/export/all", normalizer("/export"))
+        self.assertEqual("/export/v2", normalizer("/export/v2"))
+        self.assertEqual(["", "/api", "/export"], [log_analyzer.UrlNormalizer._get_prefix_key(pattern)
+                                                   for pattern in (r"^/api", r"^/api/v\d+/", r"^/export$")])
+
+    def test_normalized_report_groups_urls(self):
+        path = "./log/nginx-access-ui.log-20170530"
+        normalizer = log_analyzer.UrlNormalizer(numeric_ids=True)
+        report = log_analyzer.analyze_log(log_analyzer.parse_log(path, 100), 1000, normalizer=normalizer)
+        banners = [row for row in report if row["url"].startswith("/api/v2/banner/")]
+        self.assertEqual(["/api/v2/banner/{id}"], [row["url"] for row in banners])
+        self.assertEqual(sum(1 for url, _, _ in log_analyzer.parse_log(path, 100) if url.startswith("/api/v2/banner/")),
+                         banners[0]["count"])
+
+    def test_gzip_backends_read_same_lines(self):
+        with open("./log/nginx-access-ui.log-20170530") as f:
+            lines = f.readlines()
+        work_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(work_dir, "nginx-access-ui.log-20170530.gz")
+            for part in (lines[:7], lines[7:]):
+                with gzip.open(os.path.join(work_dir, "part.gz"), "wb") as f:
+                    f.writelines(part)
+                with open(os.path.join(work_dir, "part.gz"), "rb") as src, open(path, "ab") as dst:
+                    dst.write(src.read())
+            for backend in ("gzip", "zlib", "thread", "zcat"):
+                self.assertEqual(lines, list(log_analyzer.xreadlines(path, backend)), backend)
+            with open(path, "rb") as f:
+                data = f.read()
+            with open(path, "wb") as f:
+                f.write(data[:-4])
+            for backend in ("zlib", "thread"):
+                with self.assertRaises(EOFError):
+                    list(log_analyzer.xreadlines(path, backend))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_threaded_gzip_reader_stops_with_consumer(self):
+        work_dir = tempfile.mkdtemp()
+        read_blocks_zlib, read_block_size = log_analyzer.read_blocks_zlib, log_analyzer.READ_BLOCK_SIZE
+        state = collections.Counter()
+
+        def counted_read_blocks_zlib(path):
+            try:
+                for block in read_blocks_zlib(path):
+                    state["blocks"] += 1
+                    yield block
+            finally:
+                state["closed"] += 1
+
+        try:
+            path = os.path.join(work_dir, "nginx-access-ui.log-20170530.gz")
+            with gzip.open(path, "wb") as f:
+                for n in xrange(20000):
+                    f.write("{} {}\n".format(n, random.random()))
+            log_analyzer.read_blocks_zlib, log_analyzer.READ_BLOCK_SIZE = counted_read_blocks_zlib, 256
+            lines = log_analyzer.xreadlines(path, "thread")
+            next(lines)
+            lines.close()
+            self.assertEqual(1, state["closed"])
+            self.assertLess(state["blocks"], log_analyzer.DECOMPRESS_QUEUE_SIZE + 3)
+            state.clear()
+            self.assertEqual(20000, len(list(log_analyzer.xreadlines(path, "thread"))))
+            self.assertGreater(state["blocks"], 100)
+        finally:
+            log_analyzer.read_blocks_zlib, log_analyzer.READ_BLOCK_SIZE = read_blocks_zlib, read_block_size
+            shutil.rmtree(work_dir)
+
+    def test_log_index_lists_only_changed_dirs(self):
+        work_dir = tempfile.mkdtemp()
+        listdir = os.listdir
+        try:
+            log_dirs = [os.path.join(work_dir, host, "nginx") for host in ("web1", "web2")]
+            for log_dir in log_dirs:
+                os.makedirs(log_dir)
+                for name in ("nginx-access-ui.log-20170629", "nginx-access-ui.log-20170630.gz", "other.log"):
+                    open(os.path.join(log_dir, name), "w").close()
+            hosts = log_analyzer.get_host_names(log_analyzer.expand_log_dirs([os.path.join(work_dir, "*", "nginx")]))
+            self.assertEqual(dict(zip(log_dirs, ("web1", "web2"))), hosts)
+
+            index_path = os.path.join(work_dir, "index.json")
+            index = log_analyzer.LogIndex(index_path)
+            for log_dir, host in hosts.iteritems():
+                index.scan(host, log_dir, "nginx-access-ui.log-*")
+            pending = index.get_pending()
+            self.assertEqual([("web1", "20170629"), ("web1", "20170630"), ("web2", "20170629"), ("web2", "20170630")],
+                             [(host, log_date) for host, log_date, _ in pending])
+            index.mark_processed("web1", pending[0][2])
+            index.save()
+
+            index = log_analyzer.LogIndex(index_path)
+            os.listdir = None
+            for log_dir, host in hosts.iteritems():
+                index.scan(host, log_dir, "nginx-access-ui.log-*")
+            os.listdir = listdir
+            self.assertEqual(pending[1:], index.get_pending())
+
+            # a compressed copy of a processed day is not processed again, a new day is
+            for name in ("nginx-access-ui.log-20170629.gz", "nginx-access-ui.log-20170701"):
+                open(os.path.join(log_dirs[0], name), "w").close()
+            os.utime(log_dirs[0], (0, 0))
+            index.scan("web1", log_dirs[0], "nginx-access-ui.log-*")
+            self.assertEqual([("web1", "20170630"), ("web1", "20170701")],
+                             [(host, log_date) for host, log_date, _ in index.get_pending()[:2]])
+
+            # a failed file is not retried until it changes
+            index.mark_failed("web1", os.path.join(log_dirs[0], "nginx-access-ui.log-20170701"))
+            os.utime(log_dirs[0], (1, 1))
+            index.scan("web1", log_dirs[0], "nginx-access-ui.log-*")
+            self.assertEqual(["20170630"], [log_date for host, log_date, _ in index.get_pending() if host == "web1"])
+            with open(os.path.join(log_dirs[0], "nginx-access-ui.log-20170701"), "w") as f:
+                f.write("line\n")
+            os.utime(log_dirs[0], (2, 2))
+            index.scan("web1", log_dirs[0], "nginx-access-ui.log-*")
+            self.assertEqual(["20170630", "20170701"],
+                             [log_date for host, log_date, _ in index.get_pending() if host == "web1"])
+        finally:
+            os.listdir = listdir
+            shutil.rmtree(work_dir)
+
+    def test_hosts_are_aggregated_by_worker_pool(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            pending = []
+            for host in ("web1", "web2"):
+                path = os.path.join(work_dir, host + "-nginx-access-ui.log-20170629")
+                log_analyzer_bench.generate_log(path, 2000, n_urls=20, seed=len(pending))
+                pending.append((host, "20170629", path))
+            with open(os.path.join(work_dir, "nginx-access-ui.log-20170630"), "w") as f:
+                f.write("garbage\n" * 10)
+            pending.append(("web1", "20170630", os.path.join(work_dir, "nginx-access-ui.log-20170630")))
+
+            results = sorted(log_analyzer.aggregate_hosts(pending, os.path.join(work_dir, "aggregates"), 0.01, 2))
+            self.assertEqual(3, len(results))
+            for (host, log_date, path, urls, error), expected in zip(results, sorted(pending)):
+                self.assertEqual(expected, (host, log_date, path))
+                if log_date == "20170630":
+                    self.assertIsNone(urls)
+                    self.assertIn("corrupted", error)
+                else:
+                    self.assertIsNone(error)
+                    # exact quantiles are cached as histograms
+                    expected_urls = log_analyzer.aggregate_file(path, 0.01, quantile_mode="histogram")
+                    self.assertEqual(log_analyzer.build_report(expected_urls, 100),
+                                     log_analyzer.build_report(urls, 100))
+                    self.assertTrue(os.path.isfile(os.path.join(work_dir, "aggregates", host,
+                                                                "aggregate-20170629.json.gz")))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_corrupted_gzip_does_not_stop_other_hosts(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            good_path = os.path.join(work_dir, "web1-nginx-access-ui.log-20170629")
+            log_analyzer_bench.generate_log(good_path, 2000, n_urls=20)
+            bad_path = os.path.join(work_dir, "web2-nginx-access-ui.log-20170629.gz")
+            log_analyzer_bench.generate_log(bad_path, 20000, n_urls=20)
+            with open(bad_path, "r+b") as f:
+                f.seek(os.path.getsize(bad_path) // 2)
+                f.write("\xff" * 64)
+            pending = [("web1", "20170629", good_path), ("web2", "20170629", bad_path)]
+            for workers in (1, 2):
+                results = sorted(log_analyzer.aggregate_hosts(pending, os.path.join(work_dir, "aggregates"), 0.01,
+                                                              workers, gzip_backend="zlib"))
+                self.assertEqual(pending, [(host, log_date, path) for host, log_date, path, _, _ in results])
+                self.assertIsNone(results[0][4])
+                self.assertIsNotNone(results[0][3])
+                self.assertIsNone(results[1][3])
+                self.assertTrue(results[1][4])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_watchers_notice_new_rotated_files(self):
+        work_dir = tempfile.mkdtemp()
+        poll_interval = log_analyzer.WATCH_POLL_INTERVAL
+        try:
+            log_analyzer.WATCH_POLL_INTERVAL = 0.01
+            for get_watcher in (lambda: log_analyzer.InotifyWatcher([unicode(work_dir)], "nginx-access-ui.log-*"),
+                                lambda: log_analyzer.PollingWatcher([work_dir])):
+                watcher = get_watcher()
+                self.assertFalse(watcher.wait(0.05))
+                if isinstance(watcher, log_analyzer.InotifyWatcher):
+                    open(os.path.join(work_dir, "nginx-access-ui.log"), "w").close()
+                    self.assertFalse(watcher.wait(0.05))
+                path = os.path.join(work_dir, "nginx-access-ui.log-20170630")
+                with open(path + ".tmp", "w") as f:
+                    f.write("line\n")
+                os.rename(path + ".tmp", path)
+                self.assertTrue(watcher.wait(1))
+                watcher.close()
+                os.remove(path)
+        finally:
+            log_analyzer.WATCH_POLL_INTERVAL = poll_interval
+            shutil.rmtree(work_dir)
+
+    def test_columnar_export_reproduces_report(self):
+        path = "./log/nginx-access-ui.log-20170530"
+        work_dir = tempfile.mkdtemp()
+        try:
+            log_analyzer.export_log(path, work_dir, 100)
+            meta, columns = log_analyzer.load_columns(work_dir)
+            n_lines = len(list(log_analyzer.xreadlines(path)))
+            self.assertEqual(n_lines, meta["size"])
+            self.assertEqual(set(["200", "404"]), set(meta["dictionaries"]["status"]))
+            self.assertEqual(1498697422, columns["timestamp"][0])
+            expected = log_analyzer.analyze_log(log_analyzer.parse_log(path, 100), 1000)
+            self.assertEqual(expected, log_analyzer.build_report(log_analyzer.aggregate_columns(work_dir), 1000))
+        finally:
+            shutil.rmtree(work_dir)
+
+    @unittest.skipIf(log_analyzer.numpy is None, "numpy is not installed")
+    def test_numpy_engine_equals_python_engine(self):
+        path = "./log/nginx-access-ui.log-20170530"
+        normalizer = log_analyzer.UrlNormalizer(numeric_ids=True)
+        for quantile_mode in ("exact", "histogram"):
+            expected = log_analyzer.aggregate_log(log_analyzer.parse_log(path, 100), quantile_mode, normalizer, True)
+            for batch_size in (7, log_analyzer.LINES_PER_TASK):
+                actual = log_analyzer.numpy_aggregate_log(log_analyzer.parse_log(path, 100), quantile_mode, normalizer,
+                                                          True, batch_size)
+                for report_size in (5, 1000):
+                    self.assertEqual(log_analyzer.build_report(expected, report_size),
+                                     log_analyzer.build_report(actual, report_size))
+                self.assertEqual(log_analyzer.build_timeline(expected.timeline, "minute"),
+                                 log_analyzer.build_timeline(actual.timeline, "minute"))
+        urls = log_analyzer.aggregate_log(log_analyzer.parse_log(path, 100), timeline=True)
+        actual = log_analyzer.aggregate_file(path, 100, 2, timeline=True, engine="numpy")
+        self.assertEqual(log_analyzer.build_report(urls, 1000), log_analyzer.build_report(actual, 1000))
+        self.assertEqual(log_analyzer.build_timeline(urls.timeline), log_analyzer.build_timeline(actual.timeline))
+        work_dir = tempfile.mkdtemp()
+        try:
+            log_analyzer.export_log(path, work_dir, 100)
+            actual = log_analyzer.numpy_aggregate_columns(work_dir, timeline=True, batch_size=7)
+            self.assertEqual(log_analyzer.build_report(urls, 1000), log_analyzer.build_report(actual, 1000))
+            self.assertEqual(log_analyzer.build_timeline(urls.timeline), log_analyzer.build_timeline(actual.timeline))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_streamed_report_equals_substituted_template(self):
+        path = "./log/nginx-access-ui.log-20170530"
+        urls = log_analyzer.aggregate_log(log_analyzer.parse_log(path, 100), timeline=True)
+        report, timeline = log_analyzer.build_report(urls, 1000), log_analyzer.build_timeline(urls.timeline)
+        work_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy("./reports/report-{date}.html", work_dir)
+            with open("./reports/report-{date}.html", "r") as f:
+                expected = Template(f.read()).safe_substitute(table_json=json.dumps(report),
+                                                              timeline_json=json.dumps(timeline), data_files="null")
+            compression = ["gzip"] + (["brotli"] if log_analyzer.brotli is not None else [])
+            log_analyzer.save_report(work_dir, "report-{date}.html", "2017.05.30", report, timeline, compression)
+            with open(os.path.join(work_dir, "report-2017.05.30.html"), "r") as f:
+                self.assertEqual(expected, f.read())
+            with gzip.open(os.path.join(work_dir, "report-2017.05.30.html.gz"), "rb") as f:
+                self.assertEqual(expected, f.read())
+            if log_analyzer.brotli is not None:
+                with open(os.path.join(work_dir, "report-2017.05.30.html.br"), "rb") as f:
+                    self.assertEqual(expected, log_analyzer.brotli.decompress(f.read()))
+
+            data_file_rows = log_analyzer.REPORT_DATA_FILE_ROWS
+            try:
+                log_analyzer.REPORT_DATA_FILE_ROWS = 2
+                log_analyzer.save_report(work_dir, "report-{date}.html", "2017.05.31", report, timeline,
+                                         data_file=True)
+            finally:
+                log_analyzer.REPORT_DATA_FILE_ROWS = data_file_rows
+            names = ["report-2017.05.31-{}.ndjson".format(n) for n in xrange((len(report) + 1) // 2)]
+            rows = []
+            for name in names:
+                with open(os.path.join(work_dir, name), "r") as f:
+                    rows.extend(json.loads(line) for line in f)
+            self.assertEqual(report, rows)
+            with open(os.path.join(work_dir, "report-2017.05.31.html"), "r") as f:
+                self.assertIn("var dataFiles = {};".format(json.dumps(names)), f.read())
+            self.assertFalse([name for name in os.listdir(work_dir) if name.endswith(".tmp")])
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_bench_log_generator_is_deterministic(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(work_dir, name) for name in ("first.log", "second.log.gz")]
+            for path in paths:
+                log_analyzer_bench.generate_log(path, 2000, n_urls=50, seed=1, corruption_rate=0.05)
+            lines = list(log_analyzer.xreadlines(paths[0]))
+            self.assertEqual(lines, list(log_analyzer.xreadlines(paths[1])))
+            records = list(log_analyzer.parse_lines(lines, len(lines)))
+            self.assertTrue(1800 < len(records) < 2000)
+            self.assertEqual(records, list(log_analyzer.parse_lines(lines, len(lines), "regex")))
+            self.assertLessEqual(len(set(url for url, _, _ in records)), 51)
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_bench_refuses_baseline_with_other_params(self):
+        params = {"lines": 1000, "urls": 10, "corruption": 0.0, "seed": 42, "gzip": False}
+        self.assertEqual([], log_analyzer_bench.compare_params(params, dict(params)))
+        self.assertEqual(["gzip=False (baseline True)"],
+                         log_analyzer_bench.compare_params(params, dict(params, gzip=True)))
+
+    def test_run_metrics_count_lines_and_errors(self):
+        work_dir = tempfile.mkdtemp()
+        progress_interval = log_analyzer.PROGRESS_INTERVAL
+        try:
+            log_analyzer.PROGRESS_INTERVAL = 0
+            path = os.path.join(work_dir, "nginx-access-ui.log-20170629")
+            log_analyzer_bench.generate_log(path, 3000, n_urls=50, corruption_rate=0.05)
+            n_errors = 3000 - len(list(log_analyzer.parse_log(path, 3000)))
+            for fmt in ("json", "prometheus"):
+                metrics_path = log_analyzer.get_metrics_path(os.path.join(work_dir, "log_analyzer.ts"), fmt)
+                metrics = log_analyzer.RunMetrics(metrics_path, fmt)
+                for workers in (1, 2):
+                    with metrics.stage("aggregate{}".format(workers)) as stage:
+                        urls = log_analyzer.aggregate_file(path, 3000, workers,
+                                                           progress=metrics.progress("aggregate{}".format(workers)))
+                        self.assertTrue(stage["lines"] > 0)
+                        metrics.add_aggregates("aggregate{}".format(workers), urls, [path])
+                    self.assertEqual(n_errors, urls.n_errors)
+                with open(metrics_path, "r") as f:
+                    data = f.read()
+                if fmt == "json":
+                    stages = json.loads(data)["stages"]
+                    self.assertEqual([3000, 3000], [stages[name]["lines"] for name in ("aggregate1", "aggregate2")])
+                    self.assertEqual(n_errors, stages["aggregate2"]["errors"])
+                    self.assertEqual(os.path.getsize(path), stages["aggregate1"]["bytes"])
+                else:
+                    self.assertIn('log_analyzer_stage_errors{{stage="aggregate1"}} {}\n'.format(n_errors), data)
+        finally:
+            log_analyzer.PROGRESS_INTERVAL = progress_interval
+            shutil.rmtree(work_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
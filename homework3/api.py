@@ -1,16 +1,31 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+# imported by the first strptime call, which races when two threads make it at once
+import _strptime  # noqa
+import asynchat
+import asyncore
+import collections
+import cStringIO
+import errno
 import json
 import logging
 import hashlib
+import mimetools
+import os
+import signal
+import socket
+import threading
+import time
 import uuid
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
 import six
 import scoring
+import store as store_backend
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -19,6 +34,7 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+NOT_IMPLEMENTED = 501
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
 ERRORS = {
@@ -37,6 +53,22 @@ GENDERS = {
     FEMALE: "female",
 }
 EMPTY_VALUES = (None, (), [], {}, '')
+# the value of a field missing from the request until validate sets it to None
+NOT_SET = object()
+DATE_FORMAT = "%d.%m.%Y"
+SERVERS = ("legacy", "async")
+MAX_HEADERS_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+# a connection is not read while this many of its pipelined requests wait for their responses
+MAX_PIPELINED = 64
+SERVE_TIMEOUT = 0.5
+# handler threads of the async server, the store is called from them and never from the event loop
+HANDLER_THREADS = 8
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+# a worker dying sooner than this after its start is respawned with the same delay, so a broken worker
+# does not make the master fork in a loop
+RESPAWN_DELAY = 1.0
+GRACEFUL_TIMEOUT = 10.0
 
 
 class ValidationError(Exception):
@@ -84,18 +116,19 @@ class PhoneField(Field):
 
 
 class DateField(Field):
-    def validate(self, value):
+    def parse(self, value):
         try:
-            datetime.strptime(value, "%d.%m.%Y")
+            return datetime.strptime(value, DATE_FORMAT)
         except ValueError:
             raise ValidationError("Invalid date format")
 
+    def validate(self, value):
+        self.parse(value)
+
 
 class BirthDayField(DateField):
     def validate(self, value):
-        super(BirthDayField, self).validate(value)
-        date = datetime.strptime(value, '%d.%m.%Y')
-        if datetime.now().year - date.year > 70:
+        if datetime.now().year - self.parse(value).year > 70:
             raise ValidationError("Invalid birthday")
 
 
@@ -113,44 +146,63 @@ class ClientIDsField(Field):
             raise ValidationError("All elements must be positive integers")
 
 
+def compile_field_methods(fields):
+    # set_fields and validate_fields are generated for every request class with its fields unrolled:
+    # no loop over the fields, no getattr/setattr by name and the checks of required and nullable are resolved
+    # when the class is created
+    init = ["def set_fields(self, values):", "    get = values.get"]
+    validate = ["def validate_fields(self):", "    errors = self.errors"]
+    namespace = {"NOT_SET": NOT_SET, "EMPTY_VALUES": EMPTY_VALUES, "ValidationError": ValidationError}
+    for name, field in fields:
+        namespace["validate_" + name] = field.validate
+        init.append("    self.{0} = get({0!r}, NOT_SET)".format(name))
+        validate.extend(["    value = self.{}".format(name),
+                         "    if value is NOT_SET:",
+                         "        self.{} = None".format(name)])
+        if field.required:
+            validate.append("        errors[{!r}] = 'Field is required'".format(name))
+        validate.append("    else:")
+        if not field.nullable:
+            validate.extend(["        if value in EMPTY_VALUES:",
+                             "            errors[{!r}] = \"Field can't be blank\"".format(name)])
+        validate.extend(["        try:",
+                         "            validate_{}(value)".format(name),
+                         "        except ValidationError as e:",
+                         "            errors[{!r}] = e.message".format(name)])
+    init.append("    pass")
+    validate.append("    pass")
+    exec "\n".join(init + validate) in namespace
+    return namespace["set_fields"], namespace["validate_fields"]
+
+
 class DeclarativeFieldsMetaclass(type):
     def __new__(mcs, name, bases, attrs):
-        new_class = super(DeclarativeFieldsMetaclass, mcs).__new__(mcs, name, bases, attrs)
         fields = []
-        for field_name, field in attrs.items():
+        for field_name, field in sorted(attrs.items()):
             if isinstance(field, Field):
                 field._name = field_name
                 fields.append((field_name, field))
+                del attrs[field_name]
+        # the values of the fields live in slots, instances have no __dict__
+        attrs["__slots__"] = tuple(attrs.get("__slots__", ())) + tuple(field_name for field_name, _ in fields)
+        new_class = super(DeclarativeFieldsMetaclass, mcs).__new__(mcs, name, bases, attrs)
         new_class.fields = fields
+        new_class.field_names = frozenset(field_name for field_name, _ in fields)
+        new_class.set_fields, new_class.validate_fields = compile_field_methods(fields)
         return new_class
 
 
 class Request(object):
     __metaclass__ = DeclarativeFieldsMetaclass
+    __slots__ = ("errors", "base_fields")
 
     def __init__(self, **kwargs):
         self.errors = {}
-        self.base_fields = []
-        for field_name, value in kwargs.items():
-            setattr(self, field_name, value)
-            self.base_fields.append(field_name)
+        self.base_fields = frozenset(kwargs)
+        self.set_fields(kwargs)
 
     def validate(self):
-        for name, field in self.fields:
-            if name not in self.base_fields:
-                setattr(self, name, None)
-                if field.required:
-                    self.errors[name] = "Field is required"
-                continue
-
-            value = getattr(self, name)
-            if value in EMPTY_VALUES and not field.nullable:
-                self.errors[name] = "Field can't be blank"
-
-            try:
-                field.validate(value)
-            except ValidationError as e:
-                self.errors[name] = e.message
+        self.validate_fields()
 
     def is_valid(self):
         return not self.errors
@@ -208,7 +260,7 @@ class ClientsInterestsHandler(Handler):
         if not interests.is_valid():
             return interests.errors, INVALID_REQUEST
 
-        response_body = {client_id: scoring.get_interests(store, client_id) for client_id in interests.client_ids}
+        response_body = scoring.get_interests_many(store, interests.client_ids)
         context["nclients"] = len(interests.client_ids)
         return response_body, OK
 
@@ -220,7 +272,7 @@ class OnlineScoreHandler(Handler):
         if not score.is_valid():
             return score.errors, INVALID_REQUEST
 
-        context["has"] = score.base_fields
+        context["has"] = sorted(score.base_fields)
         score = 42 if request.is_admin else scoring.get_score(store, score.phone, score.email, score.birthday,
                                                               score.gender, score.first_name, score.last_name)
         return {"score": score}, OK
@@ -255,61 +307,433 @@ def method_handler(request, ctx, store):
     return result
 
 
+ROUTER = {
+    "method": method_handler
+}
+
+
+def handle_request(router, path, headers, data_string, context, store):
+    # the routing shared by both servers, returns the http code and the json body of the response
+    response, code = {}, OK
+    request = None
+    try:
+        request = json.loads(data_string)
+    except:
+        code = BAD_REQUEST
+
+    if request:
+        logging.info("%s: %s %s" % (path, data_string, context["request_id"]))
+        path = path.strip("/")
+        if path in router:
+            try:
+                response, code = router[path]({"body": request, "headers": headers}, context, store)
+            except Exception as e:
+                logging.exception("Unexpected error: %s" % e)
+                code = INTERNAL_ERROR
+        else:
+            code = NOT_FOUND
+
+    if code not in ERRORS:
+        r = {"response": response, "code": code}
+    else:
+        r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+    context.update(r)
+    logging.info(context)
+    return code, json.dumps(r)
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
-    router = {
-        "method": method_handler
-    }
+    router = ROUTER
     store = None
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
     def do_POST(self):
-        response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
-        request = None
         try:
             data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
         except:
-            code = BAD_REQUEST
-
-        if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
-            if path in self.router:
-                try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
-                except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
-            else:
-                code = NOT_FOUND
+            data_string = None
+        code, body = handle_request(self.router, self.path, self.headers, data_string, context, self.store)
 
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
+        self.wfile.write(body)
         return
 
 
+class Waker(asyncore.file_dispatcher):
+    # a pipe that wakes the event loop up when a worker thread completes a request
+    def __init__(self, server, map):
+        self.server = server
+        read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map)
+        os.close(read_fd)
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, "x")
+        except (OSError, TypeError):
+            # the server is closed
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.server.complete_requests()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+            self.write_fd = None
+
+
+class AsyncHTTPChannel(asynchat.async_chat):
+    # one keep-alive connection; pipelined requests are answered in the order they came in
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, server.map)
+        self.server = server
+        self.incoming = []
+        self.incoming_size = 0
+        self.request = None
+        self.responses = collections.deque()
+        self.closing = False
+        self.set_terminator("\r\n\r\n")
+
+    def readable(self):
+        return not self.closing and len(self.responses) < MAX_PIPELINED and asynchat.async_chat.readable(self)
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+        self.incoming_size += len(data)
+        if self.request is None and self.incoming_size > MAX_HEADERS_SIZE:
+            self.send_error(BAD_REQUEST)
+
+    def found_terminator(self):
+        data = "".join(self.incoming)
+        self.incoming, self.incoming_size = [], 0
+        if self.closing:
+            return
+        if self.request is not None:
+            self.handle_http_request(self.request, data)
+            return
+        try:
+            self.request = self.parse_headers(data)
+        except ValueError:
+            self.send_error(BAD_REQUEST)
+            return
+        method, _, _, headers, _ = self.request
+        content_length = headers.get("content-length", "0")
+        if method != "POST":
+            self.send_error(NOT_IMPLEMENTED)
+        elif not content_length.isdigit() or int(content_length) > MAX_BODY_SIZE:
+            self.send_error(BAD_REQUEST)
+        elif int(content_length):
+            self.set_terminator(int(content_length))
+        else:
+            self.handle_http_request(self.request, "")
+
+    def parse_headers(self, data):
+        # the handlers get the same mimetools.Message as from BaseHTTPRequestHandler
+        request_line, _, header_lines = data.partition("\r\n")
+        method, path, version = request_line.split(" ")
+        headers = mimetools.Message(cStringIO.StringIO(header_lines + "\r\n\r\n"))
+        if headers.status:
+            raise ValueError(headers.status)
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+        return method, path, version, headers, keep_alive
+
+    def handle_http_request(self, request, data):
+        _, path, version, headers, keep_alive = request
+        self.request = None
+        self.set_terminator("\r\n\r\n")
+        slot = [None, keep_alive]
+        self.responses.append(slot)
+        if not keep_alive:
+            self.closing = True
+        context = {"request_id": headers.get("x-request-id") or uuid.uuid4().hex}
+        self.server.submit(self, slot, path, headers, data, context)
+
+    def complete(self, slot, code, body):
+        slot[0] = "HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n%s\r\n%s" % (
+            code, BaseHTTPRequestHandler.responses[code][0], len(body),
+            "" if slot[1] else "Connection: close\r\n", body)
+        while self.responses and self.responses[0][0] is not None:
+            response, keep_alive = self.responses.popleft()
+            self.push(response)
+            if not keep_alive:
+                self.close_when_done()
+                self.responses.clear()
+
+    def send_error(self, code):
+        # the request can not be parsed, so the connection is closed after the error
+        self.closing = True
+        slot = [None, False]
+        self.responses.append(slot)
+        self.complete(slot, code, json.dumps({"error": ERRORS.get(code, "Unknown Error"), "code": code}))
+
+    def handle_error(self):
+        logging.exception("Unexpected connection error")
+        self.close()
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    # a single-threaded event loop, the handlers run in a pool of at least one thread,
+    # so a slow store call blocks neither the loop nor the other clients
+    def __init__(self, address, store=None, workers=HANDLER_THREADS, router=ROUTER, reuse_port=False, sock=None):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.store = store
+        self.router = router
+        if sock is not None:
+            sock.setblocking(0)
+            self.set_socket(sock, self.map)
+            self.accepting = True
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            if reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            self.bind(address)
+            self.listen(1024)
+        self.server_address = self.socket.getsockname()
+        self.pool = ThreadPool(max(workers, 1))
+        self.completed = collections.deque()
+        self.waker = Waker(self, self.map)
+        self.running = False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            pair[0].setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            AsyncHTTPChannel(pair[0], self)
+
+    def submit(self, channel, slot, path, headers, data, context):
+        args = (self.router, path, headers, data, context, self.store)
+
+        def callback(result):
+            self.completed.append((channel, slot, result))
+            self.waker.wake()
+
+        self.pool.apply_async(handle_request, args, callback=callback)
+
+    def complete_requests(self):
+        while self.completed:
+            channel, slot, (code, body) = self.completed.popleft()
+            if channel.connected:
+                channel.complete(slot, code, body)
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            asyncore.loop(SERVE_TIMEOUT, True, self.map, 1)
+
+    def shutdown(self):
+        self.running = False
+        self.waker.wake()
+
+    def server_close(self):
+        self.pool.close()
+        self.pool.join()
+        asyncore.close_all(self.map)
+
+
+def create_server(kind, address, workers=HANDLER_THREADS, store=None, reuse_port=False, sock=None):
+    # sock is a listening socket inherited from the prefork master
+    if kind == "async":
+        return AsyncHTTPServer(address, store, workers, reuse_port=reuse_port, sock=sock)
+    MainHTTPHandler.store = store
+    server = HTTPServer(address, MainHTTPHandler, bind_and_activate=False)
+    if sock is not None:
+        server.socket.close()
+        server.socket = sock
+        return server
+    if reuse_port:
+        server.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    server.server_bind()
+    server.server_activate()
+    return server
+
+
+def create_listening_socket(address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(1024)
+    return sock
+
+
+def log_cache_stats():
+    logging.info("Score cache: %s, single flight: %s" % (scoring.score_cache.get_stats(),
+                                                         dict(scoring.single_flight.stats)))
+
+
+def run_worker(kind, address, workers=HANDLER_THREADS, sock=None, store_factory=None):
+    # the master stops and replaces workers with SIGTERM, signals sent to the whole group are left to it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # connections to the store are opened after the fork, every worker has its own
+    store = store_factory() if store_factory is not None else None
+    server = create_server(kind, address, workers, store, reuse_port=sock is None, sock=sock)
+    # shutdown of HTTPServer waits for serve_forever to return, so it can't be called from the handler directly
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+    server.server_close()
+    log_cache_stats()
+
+
+class PreforkMaster(object):
+    # keeps processes workers running: a crashed worker is respawned, SIGHUP starts a new generation
+    # of workers before the old one is stopped, SIGTERM and SIGINT stop the workers gracefully
+    def __init__(self, processes, target):
+        self.processes = processes
+        self.target = target
+        self.workers = {}
+        self.retiring = set()
+        self.reloading = False
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            code = 0
+            try:
+                self.target()
+            except BaseException:
+                logging.exception("Worker %d crashed" % os.getpid())
+                code = 1
+            os._exit(code)
+        self.workers[pid] = time.time()
+        logging.info("Started worker %d" % pid)
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        else:
+            self.stopping = True
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reload(self):
+        self.reloading = False
+        old_workers = set(self.workers) - self.retiring
+        logging.info("Restarting %d workers" % len(old_workers))
+        for _ in xrange(self.processes):
+            self.spawn()
+        for pid in old_workers:
+            self.retiring.add(pid)
+            self.kill(pid, signal.SIGTERM)
+
+    def reap(self, pid, status):
+        started = self.workers.pop(pid, None)
+        if started is None:
+            return
+        if pid in self.retiring:
+            self.retiring.discard(pid)
+            logging.info("Worker %d stopped" % pid)
+            return
+        logging.error("Worker %d exited with status %d" % (pid, status))
+        if time.time() - started < RESPAWN_DELAY:
+            time.sleep(RESPAWN_DELAY)
+        if not self.stopping:
+            self.spawn()
+
+    def wait(self, options=0):
+        try:
+            return os.waitpid(-1, options)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+        return 0, 0
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle_signal)
+        for _ in xrange(self.processes):
+            self.spawn()
+        while not self.stopping:
+            if self.reloading:
+                self.reload()
+            pid, status = self.wait()
+            if pid:
+                self.reap(pid, status)
+        self.stop()
+
+    def stop(self):
+        logging.info("Stopping %d workers" % len(self.workers))
+        for pid in self.workers:
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.time() + GRACEFUL_TIMEOUT
+        while self.workers and time.time() < deadline:
+            pid, status = self.wait(os.WNOHANG)
+            if pid:
+                self.workers.pop(pid, None)
+            else:
+                time.sleep(0.05)
+        for pid in self.workers:
+            logging.error("Worker %d did not stop in time" % pid)
+            self.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.workers.clear()
+
+
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-s", "--server", action="store", type="choice", choices=SERVERS, default="legacy",
+                  help="legacy http server or async server with keep-alive and pipelining")
+    op.add_option("-w", "--workers", action="store", type=int, default=HANDLER_THREADS,
+                  help="handler threads of the async server, at least one")
+    op.add_option("-P", "--processes", action="store", type=int, default=0,
+                  help="prefork worker processes, 0 serves in the main process")
+    op.add_option("-r", "--store", action="store", default=None, help="redis host:port, no store by default")
+    op.add_option("--store-pool", action="store", type=int, default=store_backend.POOL_SIZE,
+                  help="connections to the store per process")
+    op.add_option("--store-timeout", action="store", type=float, default=store_backend.SOCKET_TIMEOUT)
+    op.add_option("--store-retries", action="store", type=int, default=store_backend.RETRIES)
+    op.add_option("--score-cache", action="store", type=int, default=scoring.SCORE_CACHE_SIZE,
+                  help="scores kept in the memory of every process, 0 disables the local cache")
+    op.add_option("--score-cache-ttl", action="store", type=int, default=scoring.SCORE_CACHE_TTL)
+    op.add_option("--coalesce-timeout", action="store", type=float, default=scoring.SINGLE_FLIGHT_TIMEOUT,
+                  help="seconds a lookup waits for the identical one in flight, 0 disables coalescing")
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    address = ("localhost", opts.port)
+    scoring.configure_score_cache(opts.score_cache, opts.score_cache_ttl)
+    scoring.configure_single_flight(opts.coalesce_timeout)
+    store_factory = None
+    if opts.store:
+        host, port = store_backend.parse_address(opts.store)
+        store_factory = lambda: store_backend.RedisStore(host, port, opts.store_pool, opts.store_timeout,
+                                                         retries=opts.store_retries)
+    if opts.processes > 0:
+        # with SO_REUSEPORT every worker binds its own socket and the kernel balances connections between them,
+        # otherwise the workers accept from the socket of the master
+        sock = None if SO_REUSEPORT else create_listening_socket(address)
+        logging.info("Starting %s server at %s with %d processes" % (opts.server, opts.port, opts.processes))
+        PreforkMaster(opts.processes, lambda: run_worker(opts.server, address, opts.workers, sock, store_factory)).run()
+        logging.info("Master stopped")
+    else:
+        server = create_server(opts.server, address, opts.workers, store_factory() if store_factory else None)
+        logging.info("Starting %s server at %s" % (opts.server, opts.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        log_cache_stats()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asynchat
+import asyncore
+import collections
+import hashlib
+import json
+import math
+import multiprocessing
+import socket
+import time
+from optparse import OptionParser
+from datetime import datetime
+
+import api
+
+METHODS = ("online_score", "clients_interests")
+ARGUMENTS = {
+    "online_score": {"phone": "79175302441", "email": "bad@ass.us", "gender": 1, "birthday": "01.01.2000",
+                     "first_name": "a", "last_name": "b"},
+    "clients_interests": {"client_ids": [1, 2, 3, 4], "date": "07.04.2018"}
+}
+REPORT_PERCENTILES = (50, 90, 99)
+
+
+def get_request_body(method, login="h&f", account="horns&hoofs"):
+    if login == api.ADMIN_LOGIN:
+        token = hashlib.sha512(datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+    else:
+        token = hashlib.sha512(account + login + api.SALT).hexdigest()
+    return json.dumps({"account": account, "login": login, "method": method, "token": token,
+                       "arguments": ARGUMENTS[method]})
+
+
+def get_http_request(host, body, keep_alive=True):
+    return ("POST /method/ HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n{}"
+            .format(host, len(body), "" if keep_alive else "Connection: close\r\n", body))
+
+
+class LoadConnection(asynchat.async_chat):
+    # keeps `depth` pipelined requests in flight on one keep-alive connection;
+    # a server that closes the connection after every response (the legacy one) is connected again
+    def __init__(self, generator, address):
+        asynchat.async_chat.__init__(self, map=generator.map)
+        self.generator = generator
+        self.sent = collections.deque()
+        self.incoming = []
+        self.content_length = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+        self.set_terminator("\r\n\r\n")
+
+    def handle_connect(self):
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for _ in xrange(self.generator.depth):
+            self.send_request()
+
+    def send_request(self):
+        if self.generator.remaining <= 0:
+            if not self.sent:
+                self.close()
+            return
+        self.generator.remaining -= 1
+        self.sent.append(time.time())
+        self.push(self.generator.request)
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        data = "".join(self.incoming)
+        self.incoming = []
+        if self.content_length is None:
+            lines = data.split("\r\n")
+            self.status = int(lines[0].split(" ")[1])
+            for line in lines[1:]:
+                name, value = line.split(":", 1)
+                if name.lower() == "content-length":
+                    self.content_length = int(value)
+            if self.content_length is None:
+                # the body lasts until the connection is closed
+                self.set_terminator(None)
+                return
+            if self.content_length:
+                self.set_terminator(self.content_length)
+                return
+        self.generator.add_result(self.status, time.time() - self.sent.popleft())
+        self.content_length = None
+        self.set_terminator("\r\n\r\n")
+        self.send_request()
+
+    def handle_close(self):
+        if self.get_terminator() is None and self.sent:
+            self.generator.add_result(self.status, time.time() - self.sent.popleft())
+        self.generator.errors += len(self.sent)
+        self.sent.clear()
+        self.close()
+        if self.generator.remaining > 0:
+            LoadConnection(self.generator, self.generator.address)
+
+    def handle_error(self):
+        self.handle_close()
+
+
+class LoadGenerator(object):
+    def __init__(self, address, connections, depth, requests, method):
+        self.address = address
+        self.connections = connections
+        self.depth = depth
+        self.remaining = requests
+        self.request = get_http_request(address[0], get_request_body(method))
+        self.map = {}
+        self.latencies = []
+        self.codes = collections.Counter()
+        self.errors = 0
+
+    def add_result(self, code, latency):
+        self.codes[code] += 1
+        self.latencies.append(latency)
+
+    def run(self):
+        started = time.time()
+        for _ in xrange(self.connections):
+            LoadConnection(self, self.address)
+        while self.map:
+            asyncore.loop(1, True, self.map, 1)
+        return self.latencies, self.codes, self.errors, time.time() - started
+
+
+def run_generator(args):
+    return LoadGenerator(*args).run()
+
+
+def percentile(values, p):
+    # nearest rank of sorted values
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)] if values else 0.0
+
+
+def run_load(address, connections=50, depth=1, requests=10000, method="online_score", processes=1):
+    # every process runs its own share of connections and requests, the latencies are merged
+    tasks = [(address, max(connections // processes, 1), depth, requests // processes + (i < requests % processes),
+              method) for i in xrange(processes)]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(run_generator, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_generator(tasks[0])]
+    latencies = sorted(latency for result in results for latency in result[0])
+    codes = collections.Counter()
+    for result in results:
+        codes.update(result[1])
+    seconds = max(result[3] for result in results)
+    report = {
+        "requests": len(latencies),
+        "errors": sum(result[2] for result in results),
+        "codes": dict(codes),
+        "seconds": seconds,
+        "rps": len(latencies) / seconds if seconds else 0.0,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0
+    }
+    for p in REPORT_PERCENTILES:
+        report["p{}_ms".format(p)] = percentile(latencies, p) * 1000
+    return report
+
+
+if __name__ == "__main__":
+    op = OptionParser(description="load generator of the scoring api, reports rps and latency percentiles")
+    op.add_option("-H", "--host", action="store", default="localhost")
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-c", "--connections", action="store", type=int, default=50)
+    op.add_option("-d", "--depth", action="store", type=int, default=1, help="pipelined requests per connection")
+    op.add_option("-n", "--requests", action="store", type=int, default=10000)
+    op.add_option("-m", "--method", action="store", type="choice", choices=METHODS, default="online_score")
+    op.add_option("-j", "--processes", action="store", type=int, default=1)
+    (opts, args) = op.parse_args()
+    report = run_load((opts.host, opts.port), opts.connections, opts.depth, opts.requests, opts.method,
+                      opts.processes)
+    print("requests={requests} errors={errors} codes={codes} time={seconds:.2f}s rps={rps:.0f}".format(**report))
+    print(" ".join("p{}={:.2f}ms".format(p, report["p{}_ms".format(p)]) for p in REPORT_PERCENTILES) +
+          " max={:.2f}ms".format(report["max_ms"]))
@@ -1,7 +1,167 @@
+import collections
+import hashlib
+import json
 import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+SCORE_CACHE_SIZE = 10000
+SCORE_CACHE_TTL = 60 * 60
+# stores without get_many are read by FETCH_THREADS threads, FETCH_CHUNK keys per task
+FETCH_CHUNK = 50
+FETCH_THREADS = 8
+# how long a lookup waits for the identical one in flight before doing its own, 0 disables coalescing
+SINGLE_FLIGHT_TIMEOUT = 1.0
+# without a store the interests of a client are random ones of these
+INTERESTS = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+
+
+class LRUCache(object):
+    # entries older than ttl are misses, over size the least recently used entry is evicted; size 0 disables it
+    def __init__(self, size=SCORE_CACHE_SIZE, ttl=SCORE_CACHE_TTL, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None or item[1] < self.clock():
+                self.stats["misses"] += 1
+                return None
+            self.items[key] = item
+            self.stats["hits"] += 1
+            return item[0]
+
+    def set(self, key, value):
+        if not self.size:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, self.clock() + self.ttl)
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+                self.stats["evictions"] += 1
+
+
+class ScoreCache(object):
+    # the local tier is checked first, so a hit costs no round trip and works while the store is down;
+    # the store tier shares scores between processes and hosts
+    def __init__(self, size=SCORE_CACHE_SIZE, ttl=SCORE_CACHE_TTL):
+        self.ttl = ttl
+        self.local = LRUCache(size, ttl)
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_shared(self, store, key):
+        cached = store.cache_get(key) if store is not None else None
+        if cached is None:
+            self.count("store_misses")
+            return None
+        score = float(cached)
+        self.local.set(key, score)
+        self.count("store_hits")
+        return score
+
+    def set(self, store, key, score):
+        self.local.set(key, score)
+        if store is not None:
+            store.cache_set(key, score, self.ttl)
+
+    def get_stats(self):
+        stats = {"local_" + name: value for name, value in self.local.stats.items()}
+        stats.update(self.stats)
+        stats["local_size"] = len(self.local.items)
+        return stats
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    # concurrent calls with the same key share the result of the first one; a caller waits at most timeout
+    # for it and then calls func itself, so a stuck call doesn't hold the others
+    def __init__(self, timeout=SINGLE_FLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+    def do(self, key, func, *args):
+        if self.timeout <= 0:
+            return func(*args)
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                self.stats["shared"] += 1
+        if not leader:
+            if flight.done.wait(self.timeout):
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+            with self.lock:
+                self.stats["timeouts"] += 1
+            return func(*args)
+        try:
+            flight.result = func(*args)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+
+score_cache = ScoreCache()
+single_flight = SingleFlight()
+fetch_pool = None
+fetch_pool_lock = threading.Lock()
+
+
+def configure_score_cache(size=SCORE_CACHE_SIZE, ttl=SCORE_CACHE_TTL):
+    global score_cache
+    score_cache = ScoreCache(size, ttl)
+
+
+def configure_single_flight(timeout=SINGLE_FLIGHT_TIMEOUT):
+    global single_flight
+    single_flight = SingleFlight(timeout)
+
+
+def get_score_key(phone, email, birthday, gender, first_name, last_name):
+    parts = [u"" if part is None else unicode(part) for part in (phone, email, birthday, gender, first_name, last_name)]
+    return "uid:" + hashlib.md5(u"\x00".join(parts).encode("utf-8")).hexdigest()
 
 
 def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, email, birthday, gender, first_name, last_name)
+    score = score_cache.local.get(key)
+    if score is None:
+        score = single_flight.do(key, load_score, store, key, phone, email, birthday, gender, first_name, last_name)
+    return score
+
+
+def load_score(store, key, phone, email, birthday, gender, first_name, last_name):
+    score = score_cache.get_shared(store, key)
+    if score is not None:
+        return score
     score = 0
     if phone:
         score += 1.5
@@ -11,9 +171,41 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
+    score_cache.set(store, key, score)
     return score
 
 
 def get_interests(store, cid):
-    interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
-    return random.sample(interests, 2)
+    if store is None:
+        return random.sample(INTERESTS, 2)
+    r = store.get("i:%s" % cid)
+    return json.loads(r) if r else []
+
+
+def get_fetch_pool():
+    # created on first use, so every prefork worker starts its own threads
+    global fetch_pool
+    with fetch_pool_lock:
+        if fetch_pool is None:
+            fetch_pool = ThreadPool(FETCH_THREADS)
+        return fetch_pool
+
+
+def fetch_many(store, keys):
+    if hasattr(store, "get_many"):
+        return store.get_many(keys)
+    chunks = [keys[i:i + FETCH_CHUNK] for i in xrange(0, len(keys), FETCH_CHUNK)]
+    if len(chunks) < 2:
+        return [store.get(key) for key in keys]
+    return [value for chunk in get_fetch_pool().map(lambda chunk: [store.get(key) for key in chunk], chunks)
+            for value in chunk]
+
+
+def get_interests_many(store, cids):
+    # sorted, so the same set of ids is one lookup for the single flight whatever order the clients send it in
+    cids = sorted(set(cids))
+    if store is None:
+        return {cid: get_interests(store, cid) for cid in cids}
+    keys = ["i:%s" % cid for cid in cids]
+    values = single_flight.do(",".join(keys), fetch_many, store, keys)
+    return {cid: json.loads(r) if r else [] for cid, r in zip(cids, values)}
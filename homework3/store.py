@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import logging
+import random
+import socket
+import time
+from six.moves import queue
+
+DEFAULT_PORT = 6379
+POOL_SIZE = 10
+# how long a call waits for a free connection when all of them are busy
+POOL_TIMEOUT = 1.0
+CONNECT_TIMEOUT = 1.0
+SOCKET_TIMEOUT = 0.5
+RETRIES = 3
+# keys per MGET, a huge batch would block the store for other clients
+MGET_CHUNK = 100
+BACKOFF = 0.05
+BACKOFF_MAX = 1.0
+
+
+class StoreError(Exception):
+    pass
+
+
+class ReplyError(StoreError):
+    pass
+
+
+def encode_command(args):
+    parts = ["*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, unicode):
+            arg = arg.encode("utf-8")
+        elif not isinstance(arg, str):
+            arg = str(arg)
+        parts.append("$%d\r\n%s\r\n" % (len(arg), arg))
+    return "".join(parts)
+
+
+class RedisConnection(object):
+    def __init__(self, host, port, timeout=SOCKET_TIMEOUT, connect_timeout=CONNECT_TIMEOUT):
+        self.sock = socket.create_connection((host, port), connect_timeout)
+        self.sock.settimeout(timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+
+    def read_line(self):
+        line = self.reader.readline()
+        if not line.endswith("\r\n"):
+            raise socket.error("connection closed by the store")
+        return line[:-2]
+
+    def read_reply(self):
+        line = self.read_line()
+        kind, value = line[:1], line[1:]
+        if kind == "+":
+            return value
+        if kind == "-":
+            raise ReplyError(value)
+        if kind == ":":
+            return int(value)
+        if kind == "$":
+            length = int(value)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise socket.error("connection closed by the store")
+            return data[:-2]
+        if kind == "*":
+            length = int(value)
+            return None if length < 0 else [self.read_reply() for _ in xrange(length)]
+        raise socket.error("unexpected reply from the store: %r" % line)
+
+    def execute(self, *args):
+        self.sock.sendall(encode_command(args))
+        return self.read_reply()
+
+    def pipeline(self, commands):
+        # the commands go in one write and their replies are read back in order: one round trip for all of them
+        self.sock.sendall("".join(encode_command(args) for args in commands))
+        replies, error = [], None
+        for _ in commands:
+            try:
+                replies.append(self.read_reply())
+            except ReplyError as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return replies
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class ConnectionPool(object):
+    # at most size connections are open, they are created on demand and reused by the following calls
+    def __init__(self, factory, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.factory = factory
+        self.timeout = timeout
+        self.queue = queue.LifoQueue(size)
+        for _ in xrange(size):
+            self.queue.put(None)
+
+    def get(self):
+        try:
+            conn = self.queue.get(timeout=self.timeout)
+        except queue.Empty:
+            raise StoreError("no free connection in %.1fs" % self.timeout)
+        if conn is None:
+            try:
+                conn = self.factory()
+            except BaseException:
+                self.queue.put(None)
+                raise
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        except ReplyError:
+            self.queue.put(conn)
+            raise
+        except BaseException:
+            # the state of the connection is unknown after a timeout or a network error
+            conn.close()
+            self.queue.put(None)
+            raise
+        self.queue.put(conn)
+
+    def close(self):
+        conns = []
+        while True:
+            try:
+                conns.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        for conn in conns:
+            if conn is not None:
+                conn.close()
+            self.queue.put(None)
+
+
+class RedisStore(object):
+    # get is used for data the response can't be built without, so it is retried and raises StoreError at last;
+    # the cache is best effort: cache calls are not retried and a failure is only logged
+    def __init__(self, host="localhost", port=DEFAULT_PORT, pool_size=POOL_SIZE, timeout=SOCKET_TIMEOUT,
+                 connect_timeout=CONNECT_TIMEOUT, retries=RETRIES, backoff=BACKOFF, backoff_max=BACKOFF_MAX):
+        self.address = (host, port)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.pool = ConnectionPool(lambda: RedisConnection(host, port, timeout, connect_timeout), pool_size)
+
+    def call(self, retries, func):
+        for attempt in xrange(retries + 1):
+            try:
+                with self.pool.connection() as conn:
+                    return func(conn)
+            except ReplyError:
+                raise
+            except (socket.error, StoreError) as e:
+                if attempt == retries:
+                    raise StoreError("store %s:%s is unavailable: %s" % (self.address + (e,)))
+                # full jitter, the clients that failed together don't retry together
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt)))
+
+    def execute(self, retries, *args):
+        return self.call(retries, lambda conn: conn.execute(*args))
+
+    def get(self, key):
+        return self.execute(self.retries, "GET", key)
+
+    def get_many(self, keys):
+        commands = [("MGET",) + tuple(keys[i:i + MGET_CHUNK]) for i in xrange(0, len(keys), MGET_CHUNK)]
+        if not commands:
+            return []
+        replies = self.call(self.retries, lambda conn: conn.pipeline(commands))
+        return [value for reply in replies for value in reply]
+
+    def cache_get(self, key):
+        try:
+            return self.execute(0, "GET", key)
+        except StoreError as e:
+            logging.warning("Cache get failed: %s" % e)
+            return None
+
+    def cache_set(self, key, value, expires=0):
+        args = ("SET", key, value) + (("EX", int(expires)) if expires else ())
+        try:
+            self.execute(0, *args)
+        except StoreError as e:
+            logging.warning("Cache set failed: %s" % e)
+
+    def close(self):
+        self.pool.close()
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    if not host:
+        return address, DEFAULT_PORT
+    return host, int(port)
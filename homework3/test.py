@@ -1,8 +1,22 @@
 import hashlib
+import json
+import mimetools
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import api
+import loadgen
+import scoring
+import store
 from functools import wraps
 from datetime import datetime
+from six.moves import socketserver
 
 
 def cases(cases_list):
@@ -35,11 +49,72 @@ class StoreMock:
             self.store[key] = value
 
 
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in xrange(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            server.commands.append(args)
+            if server.delays:
+                time.sleep(server.delays.pop(0))
+            command = args[0].upper()
+            if command == "GET":
+                value = server.data.get(args[1])
+                reply = "$-1\r\n" if value is None else "${}\r\n{}\r\n".format(len(value), value)
+            elif command == "MGET":
+                values = [server.data.get(key) for key in args[1:]]
+                reply = "*{}\r\n{}".format(len(values), "".join(
+                    "$-1\r\n" if value is None else "${}\r\n{}\r\n".format(len(value), value) for value in values))
+            elif command == "SET":
+                server.data[args[1]] = args[2]
+                reply = "+OK\r\n"
+            else:
+                reply = "-ERR unknown command '{}'\r\n".format(args[0])
+            self.wfile.write(reply)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ("localhost", 0), FakeRedisHandler)
+        self.data = {}
+        self.commands = []
+        # seconds to sleep before answering the next commands, to simulate a slow store
+        self.delays = []
+        self.connections = 0
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
 class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
         self.headers = {}
         self.store = StoreMock()
+        for cid, interests in enumerate((["cars", "pets"], ["travel", "hi-tech"], ["sport", "music"], ["books"])):
+            self.store.store["i:%s" % cid] = json.dumps(interests)
 
     def get_response(self, request):
         return api.method_handler({"body": request, "headers": self.headers}, self.context, self.store)
@@ -122,6 +197,14 @@ class TestSuite(unittest.TestCase):
         score = response.get("score")
         self.assertEqual(score, 42)
 
+    def test_request_fields_are_slots(self):
+        request = api.OnlineScoreRequest(phone="79175302441", email="bad@ass.us", validate=1, errors=2)
+        request.validate()
+        self.assertFalse(hasattr(request, "__dict__"))
+        self.assertEqual({}, request.errors)
+        self.assertEqual((None, "79175302441"), (request.first_name, request.phone))
+        self.assertEqual(frozenset(["phone", "email", "validate", "errors"]), request.base_fields)
+
     @cases([
         {},
         {"date": "07.04.2018"},
@@ -153,6 +236,355 @@ class TestSuite(unittest.TestCase):
                             for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    def test_interests_without_store(self):
+        self.store = None
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2, 2]}}
+        self.set_valid_token(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([1, 2], sorted(response))
+        self.assertTrue(all(len(v) == 2 and set(v) <= set(scoring.INTERESTS) for v in response.values()))
+
+
+class ScoreCacheTest(unittest.TestCase):
+    def setUp(self):
+        scoring.configure_score_cache()
+        self.store = StoreMock()
+        self.store.cache_get = self.count_cache_get(self.store.cache_get)
+        self.cache_gets = 0
+
+    def count_cache_get(self, cache_get):
+        def wrapper(key):
+            self.cache_gets += 1
+            return cache_get(key)
+        return wrapper
+
+    def test_local_hit_does_not_touch_store(self):
+        self.assertEqual(3.0, scoring.get_score(self.store, "79175302441", "bad@ass.us"))
+        self.assertEqual(1, self.cache_gets)
+        self.assertEqual([3.0], self.store.store.values())
+        self.assertEqual(3.0, scoring.get_score(self.store, "79175302441", "bad@ass.us"))
+        self.assertEqual(1, self.cache_gets)
+        self.assertEqual(1, scoring.score_cache.get_stats()["local_hits"])
+
+    def test_store_hit_fills_local_cache(self):
+        self.store.store[scoring.get_score_key(None, None, "01.01.2000", 1, None, None)] = "2.5"
+        self.assertEqual(2.5, scoring.get_score(self.store, None, None, "01.01.2000", 1))
+        self.assertEqual(2.5, scoring.get_score(self.store, None, None, "01.01.2000", 1))
+        stats = scoring.score_cache.get_stats()
+        self.assertEqual((1, 1, 1), (stats["store_hits"], stats["local_hits"], self.cache_gets))
+
+    def test_store_down(self):
+        self.store.is_available = False
+        self.assertEqual(0.5, scoring.get_score(self.store, None, None, first_name="a", last_name="b"))
+        self.assertEqual(0.5, scoring.get_score(self.store, None, None, first_name="a", last_name="b"))
+        self.assertEqual(1, scoring.score_cache.get_stats()["local_hits"])
+
+    def test_lru_eviction_and_ttl(self):
+        now = [0]
+        cache = scoring.LRUCache(size=2, ttl=10, clock=lambda: now[0])
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual((1, None, 3), (cache.get("a"), cache.get("b"), cache.get("c")))
+        now[0] = 11
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(1, cache.stats["evictions"])
+
+
+class InterestsTest(unittest.TestCase):
+    def test_stores_without_get_many_are_read_in_chunks(self):
+        mock = StoreMock()
+        mock.store.update(("i:%d" % cid, json.dumps([str(cid)])) for cid in xrange(300))
+        keys = []
+        get = mock.get
+        mock.get = lambda key: keys.append(key) or get(key)
+        interests = scoring.get_interests_many(mock, range(300) * 2 + [1000])
+        self.assertEqual(301, len(interests))
+        self.assertEqual(["299"], interests[299])
+        self.assertEqual([], interests[1000])
+        self.assertEqual(301, len(keys))
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def fetch(self, value, delay=0.1):
+        self.calls.append(value)
+        time.sleep(delay)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def run_concurrently(self, func, n):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func())) for _ in xrange(n)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_share_one_fetch(self):
+        flight = scoring.SingleFlight()
+        self.assertEqual([42] * 5, self.run_concurrently(lambda: flight.do("key", self.fetch, 42), 5))
+        self.assertEqual([42], self.calls)
+        self.assertEqual(4, flight.stats["shared"])
+        self.assertEqual({}, flight.flights)
+
+    def test_waiter_fetches_itself_after_timeout(self):
+        flight = scoring.SingleFlight(timeout=0.02)
+        self.assertEqual([42, 42], self.run_concurrently(lambda: flight.do("key", self.fetch, 42), 2))
+        self.assertEqual([42, 42], self.calls)
+        self.assertEqual(1, flight.stats["timeouts"])
+
+    def test_error_is_shared(self):
+        flight = scoring.SingleFlight()
+
+        def call():
+            try:
+                flight.do("key", self.fetch, ValueError("store is down"))
+            except ValueError as e:
+                return e.message
+        self.assertEqual(["store is down"] * 3, self.run_concurrently(call, 3))
+        self.assertEqual(1, len(self.calls))
+
+
+class RedisStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer()
+        self.store = store.RedisStore(*self.server.server_address, pool_size=2, timeout=0.2, backoff=0.01)
+
+    def tearDown(self):
+        self.store.close()
+        self.server.stop()
+
+    def test_get_and_cache(self):
+        self.server.data["i:1"] = '["cars", "pets"]'
+        self.assertEqual('["cars", "pets"]', self.store.get("i:1"))
+        self.assertIsNone(self.store.get("i:2"))
+        key = u"score:\u043a\u043b\u044e\u0447"
+        self.store.cache_set(key, 3.5, 60)
+        self.assertEqual("3.5", self.store.cache_get(key))
+        self.assertEqual(["SET", key.encode("utf-8"), "3.5", "EX", "60"], self.server.commands[2])
+
+    def test_connections_are_reused(self):
+        for _ in xrange(20):
+            self.store.get("key")
+        self.assertEqual(1, self.server.connections)
+
+    def test_pool_is_bounded(self):
+        self.server.delays = [0.05] * 10
+        threads = [threading.Thread(target=self.store.get, args=("key",)) for _ in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(5, len(self.server.commands))
+        self.assertEqual(2, self.server.connections)
+
+    def test_timeout_is_retried_on_new_connection(self):
+        self.server.data["key"] = "value"
+        self.server.delays = [0.5]
+        self.assertEqual("value", self.store.get("key"))
+        self.assertEqual(2, self.server.connections)
+
+    def test_unavailable_store(self):
+        self.server.stop()
+        self.assertRaises(store.StoreError, self.store.get, "key")
+        self.assertIsNone(self.store.cache_get("key"))
+        self.store.cache_set("key", "value")
+
+    def test_get_many_is_pipelined(self):
+        self.server.data.update(("i:%d" % cid, json.dumps(["cars"])) for cid in xrange(0, 250, 2))
+        values = self.store.get_many(["i:%d" % cid for cid in xrange(250)])
+        self.assertEqual([json.dumps(["cars"]), None] * 125, values)
+        self.assertEqual([101, 101, 51], [len(args) for args in self.server.commands])
+        self.assertEqual(1, self.server.connections)
+
+    def test_interests_many(self):
+        self.server.data.update({"i:1": json.dumps(["cars", "pets"]), "i:2": json.dumps(["tv"])})
+        self.assertEqual({1: ["cars", "pets"], 2: ["tv"], 3: []}, scoring.get_interests_many(self.store, [1, 2, 1, 3]))
+        self.assertEqual([["MGET", "i:1", "i:2", "i:3"]], self.server.commands)
+
+    def test_reply_error_is_not_retried(self):
+        self.assertRaises(store.ReplyError, self.store.execute, 3, "NOPE")
+        self.assertEqual(1, len(self.server.commands))
+        self.assertEqual(1, self.server.connections)
+
+
+class AsyncServerTest(unittest.TestCase):
+    def setUp(self):
+        router = dict(api.ROUTER, slow=lambda request, ctx, store: (time.sleep(0.3) or {}, api.OK))
+        self.server = api.AsyncHTTPServer(("localhost", 0), StoreMock(), workers=2, router=router)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def connect(self):
+        sock = socket.create_connection(self.server.server_address)
+        sock.settimeout(5)
+        return sock
+
+    def read_responses(self, sock, n):
+        data, responses = "", []
+        while len(responses) < n:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            while "\r\n\r\n" in data:
+                head, rest = data.split("\r\n\r\n", 1)
+                length = int(head.lower().split("content-length:")[1].split("\r\n")[0])
+                if len(rest) < length:
+                    break
+                responses.append((head, json.loads(rest[:length])))
+                data = rest[length:]
+        return responses
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        body = loadgen.get_request_body("online_score")
+        sock = self.connect()
+        sock.sendall(loadgen.get_http_request("localhost", body) + loadgen.get_http_request("localhost", "{") +
+                     loadgen.get_http_request("localhost", body).replace("/method/", "/unknown/") +
+                     loadgen.get_http_request("localhost", body))
+        responses = self.read_responses(sock, 4)
+        self.assertEqual([api.OK, api.BAD_REQUEST, api.NOT_FOUND, api.OK], [r["code"] for _, r in responses])
+        self.assertEqual(5.0, responses[0][1]["response"]["score"])
+
+        # the connection is kept alive until the client asks to close it
+        sock.sendall(loadgen.get_http_request("localhost", body, keep_alive=False))
+        head, response = self.read_responses(sock, 1)[0]
+        self.assertIn("Connection: close", head)
+        self.assertEqual("", sock.recv(1))
+        sock.close()
+
+    def test_slow_handler_does_not_block_other_clients(self):
+        slow, fast = self.connect(), self.connect()
+        slow.sendall(loadgen.get_http_request("localhost", "{\"sleep\": 1}").replace("/method/", "/slow/"))
+        time.sleep(0.05)
+        started = time.time()
+        fast.sendall(loadgen.get_http_request("localhost", loadgen.get_request_body("online_score")))
+        self.assertEqual(api.OK, self.read_responses(fast, 1)[0][1]["code"])
+        self.assertLess(time.time() - started, 0.2)
+        self.assertEqual(api.OK, self.read_responses(slow, 1)[0][1]["code"])
+        slow.close()
+        fast.close()
+
+    def test_default_server_runs_handlers_in_threads_with_message_headers(self):
+        headers, threads = [], []
+
+        def echo(request, ctx, store):
+            headers.append(request["headers"])
+            threads.append(threading.current_thread())
+            return {}, api.OK
+
+        for workers in (api.HANDLER_THREADS, 0):
+            server = api.AsyncHTTPServer(("localhost", 0), workers=workers, router={"echo": echo})
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                sock = socket.create_connection(server.server_address)
+                sock.settimeout(5)
+                sock.sendall(loadgen.get_http_request("localhost", '{"a": 1}').replace("/method/", "/echo/"))
+                self.assertEqual(api.OK, self.read_responses(sock, 1)[0][1]["code"])
+                sock.close()
+            finally:
+                server.shutdown()
+                thread.join()
+                server.server_close()
+            self.assertIsNot(thread, threads[-1])
+            self.assertIsInstance(headers[-1], mimetools.Message)
+            self.assertEqual("8", headers[-1].get("content-length"))
+
+    def test_load_generator_reports_latency(self):
+        report = loadgen.run_load(self.server.server_address, connections=3, depth=2, requests=50)
+        self.assertEqual(50, report["requests"])
+        self.assertEqual({api.OK: 50}, report["codes"])
+        self.assertTrue(0 < report["p50_ms"] <= report["p99_ms"] <= report["max_ms"])
+
+    def test_identical_lookups_are_coalesced(self):
+        calls = []
+
+        def get_many(keys):
+            calls.append(keys)
+            time.sleep(0.2)
+            return [json.dumps(["cars"])] * len(keys)
+
+        self.server.store.get_many = get_many
+        socks = [self.connect() for _ in xrange(2)]
+        for sock in socks:
+            sock.sendall(loadgen.get_http_request("localhost", loadgen.get_request_body("clients_interests")))
+        for sock in socks:
+            self.assertEqual(api.OK, self.read_responses(sock, 1)[0][1]["code"])
+            sock.close()
+        self.assertEqual(1, len(calls))
+
+    def test_inherited_listening_socket(self):
+        sock = api.create_listening_socket(("localhost", 0))
+        server = api.create_server("async", None, sock=sock)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        report = loadgen.run_load(sock.getsockname(), connections=2, requests=10)
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        self.assertEqual({api.OK: 10}, report["codes"])
+
+
+class PreforkServerTest(unittest.TestCase):
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        self.address = sock.getsockname()
+        sock.close()
+        fd, self.log_path = tempfile.mkstemp()
+        os.close(fd)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api.py")
+        self.master = subprocess.Popen([sys.executable, script, "-s", "async", "-P", "2",
+                                        "-p", str(self.address[1]), "-l", self.log_path])
+
+    def tearDown(self):
+        if self.master.poll() is None:
+            self.master.kill()
+            self.master.wait()
+        os.remove(self.log_path)
+
+    def get_workers(self, n, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with open(self.log_path) as f:
+                workers = [int(line.split()[-1]) for line in f if "Started worker" in line]
+            if len(workers) >= n:
+                time.sleep(0.3)
+                return workers
+            time.sleep(0.05)
+        self.fail("{} workers were not started".format(n))
+
+    def test_workers_are_respawned_and_restarted(self):
+        workers = self.get_workers(2)
+        self.assertEqual({api.OK: 20}, loadgen.run_load(self.address, connections=4, requests=20)["codes"])
+        os.kill(workers[0], signal.SIGKILL)
+        self.get_workers(3)
+        self.master.send_signal(signal.SIGHUP)
+        self.get_workers(5)
+        self.assertEqual({api.OK: 20}, loadgen.run_load(self.address, connections=4, requests=20)["codes"])
+        self.master.send_signal(signal.SIGTERM)
+        self.assertEqual(0, self.master.wait())
+        with open(self.log_path) as f:
+            log = f.read()
+        self.assertIn("Worker {} exited".format(workers[0]), log)
+        self.assertIn("Worker {} stopped".format(workers[1]), log)
+        self.assertIn("Master stopped", log)
+
 
 if __name__ == "__main__":
     unittest.main()
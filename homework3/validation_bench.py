@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import sys
+import time
+from optparse import OptionParser
+
+import api
+import loadgen
+
+CASES = {
+    "online_score": (api.OnlineScoreRequest, loadgen.ARGUMENTS["online_score"]),
+    "online_score_invalid": (api.OnlineScoreRequest, {"phone": "89175302441", "email": "bad", "birthday": "01.01.1890",
+                                                      "gender": 5, "first_name": 1}),
+    "clients_interests": (api.ClientsInterestsRequest, {"client_ids": range(10), "date": "20.07.2017"}),
+    "method": (api.MethodRequest, json.loads(loadgen.get_request_body("online_score"))),
+}
+
+
+def bench_case(request_class, arguments, n):
+    start = time.time()
+    for _ in xrange(n):
+        request = request_class(**arguments)
+        request.validate()
+        request.is_valid()
+    return n / (time.time() - start)
+
+
+def main(opts):
+    results = {}
+    for name, (request_class, arguments) in sorted(CASES.items()):
+        # the best of three runs, the others are disturbed by the machine
+        results[name] = max(bench_case(request_class, arguments, opts.requests) for _ in xrange(3))
+        print("{:<24} {:.0f} requests/s".format(name, results[name]))
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if opts.baseline:
+        with open(opts.baseline, 'r') as f:
+            baseline = json.load(f)
+        for name, rate in sorted(results.items()):
+            if baseline.get(name):
+                print("{:<24} baseline={:.0f}/s current={:.0f}/s change={:+.1%}".format(
+                      name, baseline[name], rate, rate / baseline[name] - 1))
+    return 0
+
+
+if __name__ == "__main__":
+    op = OptionParser(description="validation of the request classes, requests per second")
+    op.add_option("-n", "--requests", action="store", type=int, default=20000)
+    op.add_option("-o", "--output", action="store", default=None, help="save results as json")
+    op.add_option("-b", "--baseline", action="store", default=None, help="compare results with a saved json")
+    (opts, args) = op.parse_args()
+    sys.exit(main(opts))